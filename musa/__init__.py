@@ -7,9 +7,14 @@ Audio file processing libraries
 
 import os
 import sys
+import json
+import tempfile
+import threading
 import unicodedata
 
-from musa.defaults import MUSA_USER_DIR
+from musa.defaults import MUSA_USER_DIR, MUSA_CACHE_DIR
+
+COMMAND_PATH_CACHE = os.path.join(MUSA_CACHE_DIR, 'commands.json')
 
 class MusaError(Exception):
     pass
@@ -31,49 +36,225 @@ class CommandPathCache(list):
 
     """
     Class to represent commands on user's search path.
+
+    Commands are indexed by name. PATH directories are scanned lazily in
+    search order, only until the looked up command is found. Directory
+    listings are cached to cache_path and reused while directory mtime is
+    unchanged. Commands found from cached listings are checked to still be
+    executable, and missing commands are checked from each PATH directory
+    before they are reported missing. Directories with stale cached
+    listings are listed again. Lookups may be done from several threads.
     """
-    def __init__(self):
+    def __init__(self, cache_path=COMMAND_PATH_CACHE):
         list.__init__(self)
-        self.paths = None
-        self.update()
+        self.cache_path = cache_path
+        self.lock = threading.RLock()
+        self.paths = []
+        self.index = {}
+        self.scanned = 0
+        self.cached = {}
+        self.listed = set()
+        self.modified = False
 
-    def update(self):
+        for path in os.getenv('PATH', '').split(os.pathsep):
+            if path and not self.paths.count(path):
+                self.paths.append(path)
+        self.load()
+
+    def load(self):
         """
-        Updates the commands available on user's PATH
+        Load cached directory listings
         """
-        self.paths = []
-        self.__delslice__(0, len(self))
-        for path in os.getenv('PATH').split(os.pathsep):
-            if not self.paths.count(path):
-                self.paths.append(path)
-        for path in self.paths:
-            if not os.path.isdir(path):
-                continue
-            for cmd in [os.path.join(path, f) for f in os.listdir(path)]:
-                if os.path.isdir(cmd) or not os.access(cmd, os.X_OK):
-                    continue
+        try:
+            with open(self.cache_path, 'r') as fd:
+                self.cached = json.load(fd)
+        except (IOError, OSError, ValueError):
+            self.cached = {}
+
+    def save(self):
+        """
+        Save directory listings to cache, if new directories were scanned
+        """
+        if not self.modified:
+            return
+
+        try:
+            directory = os.path.dirname(self.cache_path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.commands-')
+            with os.fdopen(fd, 'w') as output:
+                json.dump(self.cached, output)
+            os.rename(tmp, self.cache_path)
+            self.modified = False
+        except (IOError, OSError):
+            # Cache is only an optimization
+            pass
+
+    def is_command(self, path):
+        """
+        Check if path is an executable command
+        """
+        return not os.path.isdir(path) and os.access(path, os.X_OK)
+
+    def list_directory(self, path, use_cache=True):
+        """
+        Return names of executable commands in directory. Directories are
+        listed only once after update(), use_cache only skips listings
+        cached by earlier runs.
+        """
+        if path in self.listed:
+            return self.cached[path]['commands']
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return []
+
+        entry = self.cached.get(path)
+        if use_cache and entry is not None and entry['mtime'] == mtime:
+            return entry['commands']
+
+        commands = []
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if self.is_command(os.path.join(path, name)):
+                    commands.append(name)
+
+        self.cached[path] = {'mtime': mtime, 'commands': commands}
+        self.listed.add(path)
+        self.modified = True
+        return commands
+
+    def scan_next(self, use_cache=True):
+        """
+        Scan next directory on PATH. Returns False if all directories were
+        already scanned.
+        """
+        with self.lock:
+            if self.scanned >= len(self.paths):
+                return False
+
+            path = self.paths[self.scanned]
+            for name in self.list_directory(path, use_cache):
+                cmd = os.path.join(path, name)
+                self.index.setdefault(name, []).append(cmd)
                 self.append(cmd)
+            self.scanned += 1
+            return True
+
+    def reset(self):
+        """
+        Clear command index
+        """
+        with self.lock:
+            self.__delslice__(0, len(self))
+            self.index = {}
+            self.scanned = 0
+
+    def refresh(self, paths):
+        """
+        List directories read from cache again, at most once per process,
+        and update index of scanned directories
+        """
+        with self.lock:
+            paths = [path for path in paths if path not in self.listed]
+            if not paths:
+                return
+
+            for path in paths:
+                self.list_directory(path, use_cache=False)
+            scanned = self.scanned
+            self.reset()
+            while self.scanned < scanned and self.scan_next():
+                pass
+
+    def lookup(self, name):
+        """
+        Return commands with given name in PATH directories, checking each
+        directory without listing it
+        """
+        commands = []
+        for path in self.paths:
+            cmd = os.path.join(path, name)
+            if self.is_command(cmd):
+                commands.append(cmd)
+        return commands
+
+    def update(self):
+        """
+        Updates the commands available on user's PATH. Directories are
+        scanned again lazily on next lookup.
+        """
+        with self.lock:
+            self.reset()
+            self.listed = set()
 
     def versions(self, name):
         """
         Returns all commands with given name on path, ordered by PATH search
         order.
         """
-        if not len(self):
-            self.update()
-        return filter(lambda x: os.path.basename(x) == name, self)
+        with self.lock:
+            while self.scan_next():
+                pass
+            commands = self.index.get(name, [])
+            found = self.lookup(name)
+            if found != commands:
+                # Cached listings differ from the directories
+                self.refresh(set(os.path.dirname(cmd) for cmd in set(commands) ^ set(found)))
+            self.save()
+            return found
 
     def which(self, name):
         """
         Return first matching path to command given with name, or None if
         command is not on path
         """
-        if not len(self):
-            self.update()
+        with self.lock:
+            while name not in self.index:
+                if not self.scan_next():
+                    break
+            commands = self.index.get(name, [])
+            if commands and self.is_command(commands[0]):
+                self.save()
+                return commands[0]
+
+            # Cached listings miss commands made executable without changing
+            # directory mtime, and may contain removed commands
+            found = self.lookup(name)
+            stale = set(os.path.dirname(cmd) for cmd in commands[:1] + found[:1])
+            if stale:
+                self.refresh(stale)
+            self.save()
+            try:
+                return found[0]
+            except IndexError:
+                return None
+
+
+def install_path_cache():
+    """
+    Use CommandPathCache for codec command lookups in soundforest.formats.
+
+    The formats module builds its command cache with a full PATH scan when
+    it's imported. The lazy cache class replaces soundforest.CommandPathCache
+    only while the formats module is imported.
+    """
+    import soundforest
+    formats = sys.modules.get('soundforest.formats')
+    if formats is None:
+        original = soundforest.CommandPathCache
+        soundforest.CommandPathCache = CommandPathCache
         try:
-            return filter(lambda x: os.path.basename(x) == name, self)[0]
-        except IndexError:
-            return None
+            import soundforest.formats
+        finally:
+            soundforest.CommandPathCache = original
+
+    elif not isinstance(formats.PATH_CACHE, CommandPathCache):
+        formats.PATH_CACHE = CommandPathCache()
+
+install_path_cache()
 
 if not os.path.isdir(MUSA_USER_DIR):
     try:
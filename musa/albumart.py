@@ -0,0 +1,142 @@
+# coding=utf-8
+"""Album art
+
+Album art images prepared once for embedding to all tracks of an album
+
+"""
+
+import os
+import StringIO
+
+from PIL import Image
+
+from soundforest.metadata import CoverArt
+from soundforest.tags.albumart import AlbumArt, AlbumArtError, PIL_MIME_MAP, DEFAULT_ARTWORK_FILENAME
+
+# JPEG quality used when resized images are encoded
+RESIZED_JPEG_QUALITY = 90
+
+
+def album_cover_path(album):
+    """
+    Return path to cover art file of album, or None if album has no cover
+    """
+    for m in album.metadata:
+        if isinstance(getattr(m, 'metadata', None), CoverArt):
+            return m.path
+    return None
+
+
+class PreparedAlbumArt(AlbumArt):
+    """
+    Album art with encoded image bytes stored when image is imported.
+
+    Images larger than max_size pixels in either dimension are downscaled
+    when imported. Otherwise original bytes are kept as they are, and
+    embedding the same image to many tracks does not encode it again for
+    each track.
+    """
+    def __init__(self, path=None, max_size=None):
+        self.max_size = max_size
+        self.fileformat = None
+        self.data = None
+        AlbumArt.__init__(self, path)
+
+    def __len__(self):
+        """
+        Returns length of stored image bytes
+        """
+        if self.data is None:
+            return 0
+        return len(self.data)
+
+    def resize(self, image):
+        """
+        Return bytes of image downscaled to fit max_size, encoded in the
+        original file format
+        """
+        fileformat = image.format
+        try:
+            if fileformat == 'JPEG' and image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.thumbnail((self.max_size, self.max_size), Image.ANTIALIAS)
+
+            s = StringIO.StringIO()
+            if fileformat == 'JPEG':
+                image.save(s, fileformat, quality=RESIZED_JPEG_QUALITY, optimize=True)
+            else:
+                image.save(s, fileformat, optimize=True)
+            return s.getvalue()
+
+        except IOError, emsg:
+            raise AlbumArtError('Error resizing albumart image: %s' % emsg)
+
+    def import_data(self, data):
+        """
+        Import albumart from bytes, resizing it if needed
+        """
+        try:
+            image = Image.open(StringIO.StringIO(data))
+        except IOError:
+            raise AlbumArtError('Error parsing albumart image data')
+
+        if image.format not in PIL_MIME_MAP:
+            raise AlbumArtError('Unsupported PIL image format: %s' % image.format)
+
+        if self.max_size and max(image.size) > self.max_size:
+            data = self.resize(image)
+
+        AlbumArt.import_data(self, data)
+        self.fileformat = image.format
+        self.data = data
+
+    def import_file(self, path):
+        """
+        Import albumart from file
+        """
+        if not os.path.isfile(path):
+            raise AlbumArtError('No such file: %s' % path)
+
+        try:
+            with open(path, 'rb') as fd:
+                data = fd.read()
+        except IOError, (ecode, emsg):
+            raise AlbumArtError('Error reading file %s: %s' % (path, emsg))
+
+        self.import_data(data)
+
+    def get_fileformat(self):
+        """
+        Return file format of imported image bytes
+        """
+        if self.fileformat is None:
+            raise AlbumArtError('AlbumArt not yet initialized.')
+        return self.fileformat
+
+    def dump(self):
+        """
+        Returns stored image bytes
+        """
+        if self.data is None:
+            raise AlbumArtError('AlbumArt not yet initialized.')
+        return self.data
+
+    def save(self, path, fileformat=None):
+        """
+        Saves stored image bytes to given target file, or converts the image
+        if different file format is requested.
+        """
+        if fileformat is not None and fileformat != self.get_fileformat():
+            return AlbumArt.save(self, path, fileformat)
+
+        if self.data is None:
+            raise AlbumArtError('AlbumArt not yet initialized.')
+
+        if os.path.isdir(path):
+            path = os.path.join(path, DEFAULT_ARTWORK_FILENAME)
+
+        try:
+            with open(path, 'wb') as fd:
+                fd.write(self.data)
+        except IOError, (ecode, emsg):
+            raise AlbumArtError('Error saving %s: %s' % (path, emsg))
@@ -0,0 +1,266 @@
+# coding=utf-8
+"""Transcode cache
+
+Persistent cache of transcoded files, keyed by source file and encoder
+settings
+
+"""
+
+import os
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import time
+
+from musa.defaults import MUSA_CACHE_DIR, TARGET_FILE_MODE
+
+TRANSCODE_CACHE_DIR = os.path.join(MUSA_CACHE_DIR, 'transcoded')
+TRANSCODE_CACHE_DB = os.path.join(MUSA_CACHE_DIR, 'transcoded.sqlite')
+TRANSCODE_SOURCES_DB = os.path.join(MUSA_CACHE_DIR, 'sources.sqlite')
+
+# Default maximum cache size in megabytes
+DEFAULT_TRANSCODE_CACHE_SIZE = 10240
+
+HASH_BLOCK_SIZE = 1024*1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key         TEXT PRIMARY KEY,
+    filename    TEXT NOT NULL,
+    size        INTEGER NOT NULL,
+    atime       REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime);
+"""
+
+SOURCES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    target      TEXT PRIMARY KEY,
+    size        INTEGER NOT NULL,
+    mtime       REAL NOT NULL
+);
+"""
+
+
+class CacheError(Exception):
+    pass
+
+
+class TranscodeCache(object):
+    """
+    Cache of encoded files in MUSA_CACHE_DIR.
+
+    Entries are keyed by source file identity and encoder command. By default
+    source is identified by path, inode, size and mtime; with hash_content
+    the sha1 checksum of source file is used instead, allowing cache hits
+    for identical files in different paths.
+
+    Least recently used entries are removed when cache grows over max_size
+    megabytes.
+    """
+    def __init__(self, path=TRANSCODE_CACHE_DIR, db_path=TRANSCODE_CACHE_DB,
+                 max_size=DEFAULT_TRANSCODE_CACHE_SIZE, hash_content=False):
+        self.path = path
+        self.db_path = db_path
+        self.max_size = int(max_size) * 1024 * 1024
+        self.hash_content = hash_content
+        self.lock = threading.Lock()
+        self.__connection = None
+        self.__pid = None
+
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError, (ecode, emsg):
+                if not os.path.isdir(self.path):
+                    raise CacheError('Error creating directory %s: %s' % (self.path, emsg))
+
+    @property
+    def connection(self):
+        """
+        Database connection, opened separately in each forked process
+        """
+        if self.__connection is None or self.__pid != os.getpid():
+            self.__connection = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+            self.__connection.executescript(SCHEMA)
+            self.__pid = os.getpid()
+        return self.__connection
+
+    def checksum(self, path):
+        """
+        Return sha1 checksum of file contents
+        """
+        checksum = hashlib.sha1()
+        with open(path, 'rb') as fd:
+            while True:
+                data = fd.read(HASH_BLOCK_SIZE)
+                if not data:
+                    break
+                checksum.update(data)
+        return checksum.hexdigest()
+
+    def key(self, src, encoder):
+        """
+        Return cache key for source file path and encoder command string
+        """
+        try:
+            if self.hash_content:
+                source = self.checksum(src)
+            else:
+                st = os.stat(src)
+                source = '%s:%d:%d:%d' % (os.path.realpath(src), st.st_ino, st.st_size, st.st_mtime)
+        except (IOError, OSError), (ecode, emsg):
+            raise CacheError('Error reading %s: %s' % (src, emsg))
+
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        if isinstance(encoder, unicode):
+            encoder = encoder.encode('utf-8')
+        return hashlib.sha1('%s\0%s' % (source, encoder)).hexdigest()
+
+    def copy(self, src, dst):
+        """
+        Copy file via temporary file in target directory, to never leave
+        partial files in cache or target paths. Copies get the permissions
+        of files written by encoders.
+        """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst), prefix='.musa-')
+        os.close(fd)
+        try:
+            shutil.copyfile(src, tmp)
+            os.chmod(tmp, TARGET_FILE_MODE)
+            os.rename(tmp, dst)
+        except (IOError, OSError), (ecode, emsg):
+            if os.path.isfile(tmp):
+                os.unlink(tmp)
+            raise CacheError('Error copying %s to %s: %s' % (src, dst, emsg))
+
+    def fetch(self, key, dst):
+        """
+        Copy cached file for key to dst. Returns True if key was found.
+        """
+        with self.lock:
+            c = self.connection.cursor()
+            c.execute('SELECT filename FROM entries WHERE key=?', (key, ))
+            entry = c.fetchone()
+            if entry is None:
+                return False
+
+            path = os.path.join(self.path, entry[0])
+            if not os.path.isfile(path):
+                c.execute('DELETE FROM entries WHERE key=?', (key, ))
+                self.connection.commit()
+                return False
+
+            c.execute('UPDATE entries SET atime=? WHERE key=?', (time.time(), key))
+            self.connection.commit()
+
+        self.copy(path, dst)
+        return True
+
+    def store(self, key, src):
+        """
+        Store a copy of file src to cache with given key
+        """
+        filename = '%s%s' % (key, os.path.splitext(src)[1])
+        path = os.path.join(self.path, filename)
+        self.copy(src, path)
+
+        with self.lock:
+            c = self.connection.cursor()
+            c.execute(
+                'INSERT OR REPLACE INTO entries (key, filename, size, atime) VALUES (?, ?, ?, ?)',
+                (key, filename, os.stat(path).st_size, time.time())
+            )
+            self.connection.commit()
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until cache fits in max_size
+        """
+        with self.lock:
+            c = self.connection.cursor()
+            c.execute('SELECT SUM(size) FROM entries')
+            total = c.fetchone()[0] or 0
+            if total <= self.max_size:
+                return
+
+            c.execute('SELECT key, filename, size FROM entries ORDER BY atime')
+            removed = []
+            for key, filename, size in c.fetchall():
+                if total <= self.max_size:
+                    break
+                try:
+                    os.unlink(os.path.join(self.path, filename))
+                except OSError:
+                    pass
+                removed.append((key, ))
+                total -= size
+
+            c.executemany('DELETE FROM entries WHERE key=?', removed)
+            self.connection.commit()
+
+
+class TranscodeSources(object):
+    """
+    Size and mtime of source files when targets were transcoded, to detect
+    sources replaced with files having older mtime than the target.
+    """
+    def __init__(self, db_path=TRANSCODE_SOURCES_DB):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.__connection = None
+        self.__pid = None
+
+        directory = os.path.dirname(self.db_path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, (ecode, emsg):
+                if not os.path.isdir(directory):
+                    raise CacheError('Error creating directory %s: %s' % (directory, emsg))
+
+    @property
+    def connection(self):
+        """
+        Database connection, opened separately in each forked process
+        """
+        if self.__connection is None or self.__pid != os.getpid():
+            self.__connection = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+            self.__connection.executescript(SOURCES_SCHEMA)
+            self.__pid = os.getpid()
+        return self.__connection
+
+    def get(self, target):
+        """
+        Return (size, mtime) of source when target was written, or None
+        """
+        with self.lock:
+            try:
+                c = self.connection.cursor()
+                c.execute('SELECT size, mtime FROM sources WHERE target=?', (target, ))
+                return c.fetchone()
+            except sqlite3.Error, emsg:
+                raise CacheError('Error reading %s: %s' % (self.db_path, emsg))
+
+    def store(self, target, src):
+        """
+        Record current size and mtime of src for target
+        """
+        try:
+            st = os.stat(src)
+        except OSError, (ecode, emsg):
+            raise CacheError('Error reading %s: %s' % (src, emsg))
+
+        with self.lock:
+            try:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO sources (target, size, mtime) VALUES (?, ?, ?)',
+                    (target, st.st_size, st.st_mtime)
+                )
+                self.connection.commit()
+            except sqlite3.Error, emsg:
+                raise CacheError('Error writing %s: %s' % (self.db_path, emsg))
@@ -0,0 +1,110 @@
+# coding=utf-8
+"""Tree cleanup
+
+Removal of unwanted files and directories left empty from music trees
+
+"""
+
+import os
+
+from musa.rename import STAGING_PREFIX
+from musa.sync import SYNC_MANIFEST
+from musa.walker import TreeWalker
+from soundforest.formats import match_codec, match_metadata
+from soundforest.log import SoundforestLogger
+
+
+class TreeCleanup(object):
+    """
+    Removes unwanted files from a tree in one walk, then directories left
+    empty bottom up. Tree root directory is never removed.
+
+    Directories are listed with the tree walker. Only the directories seen
+    and their remaining file counts are kept for the bottom up pass, not
+    the file listings.
+    """
+    def __init__(self, walker, dry_run=False):
+        if not isinstance(walker, TreeWalker):
+            walker = TreeWalker(walker)
+        self.walker = walker
+        self.path = walker.path
+        self.dry_run = dry_run
+        self.log = SoundforestLogger().default_stream
+
+        self.files_removed = 0
+        self.dirs_removed = 0
+        self.reclaimed = 0
+
+    def is_unwanted(self, path):
+        """
+        Check if file in tree should be removed. Files are kept if they are
+        audio files, metadata files not marked removable, sync manifests or
+        files staged by an interrupted bulk rename.
+        """
+        if match_codec(path) is not None:
+            return False
+
+        name = os.path.basename(path)
+        if name == SYNC_MANIFEST or name.startswith(STAGING_PREFIX):
+            return False
+
+        metadata = match_metadata(path)
+        if metadata:
+            if not getattr(metadata, 'removable', False):
+                return False
+            self.log.debug('Unwanted metadata %s: %s' % (metadata, path))
+        else:
+            self.log.debug('Unknown file type: %s' % path)
+        return True
+
+    def run(self):
+        """
+        Yield ('file' or 'directory', path, error) for each path removed, or
+        which would be removed with dry_run. Error is None for removed paths.
+        """
+        # (root, subdirectories, files kept) in top down walk order
+        directories = []
+        for root, subdirectories, files in self.walker.walk():
+            remaining = 0
+            for name in files:
+                path = os.path.join(root, name)
+                if not self.is_unwanted(path):
+                    remaining += 1
+                    continue
+
+                try:
+                    size = os.lstat(path).st_size
+                except OSError:
+                    size = 0
+
+                if not self.dry_run:
+                    try:
+                        os.unlink(path)
+                    except OSError, (ecode, emsg):
+                        remaining += 1
+                        yield 'file', path, 'Error removing %s: %s' % (path, emsg)
+                        continue
+
+                self.files_removed += 1
+                self.reclaimed += size
+                yield 'file', path, None
+
+            directories.append((root, subdirectories, remaining))
+
+        # Directories removed, or which would be removed with dry_run
+        removed = set()
+        for root, subdirectories, remaining in reversed(directories):
+            remaining += len([d for d in subdirectories if os.path.join(root, d) not in removed])
+            if remaining or root == self.path:
+                continue
+
+            if not self.dry_run:
+                try:
+                    os.rmdir(root)
+                except OSError, (ecode, emsg):
+                    yield 'directory', root, 'Error removing empty directory %s: %s' % (root, emsg)
+                    continue
+
+            removed.add(root)
+            self.dirs_removed += 1
+            yield 'directory', root, None
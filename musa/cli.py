@@ -7,47 +7,318 @@ Command line utilities for musa
 
 import sys
 import os
-import time
 import logging
 import argparse
 import tempfile
 import signal
 import socket
 import threading
+import multiprocessing
+import Queue
 import subprocess
 
+from musa.tagcache import TagCache, TagCacheError
+from musa.walker import MusaTree, DEFAULT_WALKER_THREADS
 from soundforest.cli import Script, ScriptCommand, ScriptThread, ScriptThreadManager, ScriptError
 from soundforest.prefixes import TreePrefixes
 from soundforest.formats import match_metadata, match_codec
-from soundforest.tree import Tree, Track, TreeError
+from soundforest.tree import Track, TreeError
+
+EXECUTORS = (
+    'threads',
+    'processes',
+)
+DEFAULT_EXECUTOR = 'threads'
+
+# Manager inherited by forked process pool workers
+_process_manager = None
+
+def _process_job(job):
+    """
+    Process pool worker callback. Only job position is passed to the worker:
+    the entries are inherited from parent process when the pool is forked.
+    """
+    position, index = job
+    return position, _process_manager.execute(index, _process_manager.jobs[position][1])
+
+def error_message(emsg):
+    """
+    Return exception message as string, also for messages with non-ascii
+    paths
+    """
+    try:
+        return str(emsg)
+    except UnicodeError:
+        pass
+    try:
+        return unicode(emsg)
+    except UnicodeError:
+        return repr(emsg)
+
+def run_track(callback, item):
+    """
+    Run callback for item, returning (item, result, error) tuple
+    """
+    try:
+        return item, callback(item), None
+
+    except SystemExit, emsg:
+        return item, None, 'exit %s' % error_message(emsg)
+
+    except Exception, emsg:
+        return item, None, error_message(emsg)
+
+def ordered_map(callback, items, threads, window=None):
+    """
+    Run callback for items in a pool of worker threads, yielding
+    (item, result, error) tuples in the order of items. At most window
+    items are queued at the same time.
+    """
+    if window is None:
+        window = threads * 4
+
+    pending = Queue.Queue()
+    finished = Queue.Queue()
+
+    def worker():
+        while True:
+            job = pending.get()
+            if job is None:
+                break
+            position, item = job
+            finished.put((position, run_track(callback, item)))
+
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    for t in workers:
+        t.setDaemon(True)
+        t.start()
+
+    results = {}
+    queued = 0
+    done = 0
+    try:
+        items = iter(items)
+        while True:
+            while queued - done < window:
+                try:
+                    item = items.next()
+                except StopIteration:
+                    break
+                pending.put((queued, item))
+                queued += 1
+
+            if done == queued:
+                break
+
+            while done not in results:
+                try:
+                    # Timeout keeps main thread responsive to signals
+                    position, result = finished.get(True, 1)
+                except Queue.Empty:
+                    continue
+                results[position] = result
+
+            yield results.pop(done)
+            done += 1
+
+    finally:
+        for t in workers:
+            pending.put(None)
+        for t in workers:
+            t.join()
+
+class MusaJobResult(object):
+    """
+    Result of one job processed by MusaThreadManager workers
+    """
+    def __init__(self, index, entry, error=None):
+        self.index = index
+        self.entry = entry
+        self.error = error
+
+    def __repr__(self):
+        if self.error is not None:
+            return '%s error: %s' % (self.index, self.error)
+        return '%s ok' % self.index
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class MusaWorker(threading.Thread):
+    """
+    Worker thread processing jobs from MusaThreadManager queue until it
+    receives None as job.
+    """
+    def __init__(self, manager):
+        threading.Thread.__init__(self)
+        self.manager = manager
+        self.setDaemon(True)
+        self.setName('%s-worker' % manager.name)
+
+    def run(self):
+        while True:
+            job = self.manager.queue.get()
+            try:
+                if job is None:
+                    break
+                index, entry = job
+                self.manager.process(index, entry)
+            finally:
+                self.manager.queue.task_done()
+
 
 class MusaThreadManager(ScriptThreadManager):
-    def __init__(self, name, threads=None):
+    """
+    Runs queued entries with a fixed pool of workers.
+
+    Entries are converted to handlers with get_entry_handler() and the
+    handler run() method is called in a worker thread, or in a forked worker
+    process with 'processes' executor. Results of the jobs are collected to
+    self.results as MusaJobResult objects.
+    """
+    def __init__(self, name, threads=None, executor=None):
         ScriptThreadManager.__init__(self, name, threads)
+        self.name = name
+        self.threads = int(self.threads)
+
+        if executor is None:
+            executor = self.db.get('executor')
+            if executor is None:
+                executor = DEFAULT_EXECUTOR
+        if executor not in EXECUTORS:
+            raise ScriptError('Unknown executor: %s' % executor)
+        self.executor = executor
+
+        self.queue = None
+        self.jobs = []
+        self.results = []
+        self.lock = threading.Lock()
 
     def enqueue(self, item):
-        self.log.debug('enqueue: %s' % (src.path))
-        self.append((src, dst))
+        self.log.debug('enqueue: %s' % (item, ))
+        self.append(item)
+
+    @property
+    def errors(self):
+        return [r for r in self.results if not r.ok]
+
+    def execute(self, index, entry):
+        """
+        Run handler for one entry, returning error message or None
+        """
+        error = None
+        try:
+            handler = self.get_entry_handler(index, entry)
+            handler.run()
+
+        except SystemExit, emsg:
+            # Handlers report fatal errors by calling sys.exit()
+            error = 'exit %s' % error_message(emsg)
+
+        except Exception, emsg:
+            error = error_message(emsg)
+
+        if error is not None:
+            self.log.info('Error processing %s: %s' % (index, error))
+
+        return error
+
+    def process(self, index, entry):
+        """
+        Process one entry in worker thread
+        """
+        error = self.execute(index, entry)
+        with self.lock:
+            self.results.append(MusaJobResult(index, entry, error))
+
+    def run_threads(self, workers):
+        self.queue = Queue.Queue()
+
+        workers = [MusaWorker(self) for i in range(workers)]
+        for worker in workers:
+            worker.start()
+
+        for index, entry in self.jobs:
+            self.queue.put((index, entry))
+
+        for worker in workers:
+            self.queue.put(None)
+
+        # Join with timeout to keep main thread responsive to signals
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(1)
+
+    def run_processes(self, workers):
+        global _process_manager
+        _process_manager = self
+
+        pool = multiprocessing.Pool(processes=workers)
+        try:
+            jobs = [(position, job[0]) for position, job in enumerate(self.jobs)]
+            for position, error in pool.imap_unordered(_process_job, jobs):
+                index, entry = self.jobs[position]
+                self.results.append(MusaJobResult(index, entry, error))
+            pool.close()
+
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+
+        finally:
+            pool.join()
+            _process_manager = None
 
     def run(self):
         if len(self)==0:
-            return
+            return []
 
         total = len(self)
+        self.results = []
+        self.jobs = []
         while len(self)>0:
-            active = threading.active_count()
-            if active > self.threads:
-                time.sleep(0.5)
-                continue
+            self.jobs.append(('%d/%d' % (len(self.jobs)+1, total), self.pop(0)))
+
+        workers = min(max(self.threads, 1), total)
+        if self.executor == 'processes':
+            self.run_processes(workers)
+        else:
+            self.run_threads(workers)
+
+        self.jobs = []
+        return self.results
 
-            index = '%d/%d' % (total-len(self)+1, total)
-            t = self.get_entry_handler(index, self.pop(0))
-            t.start()
 
-        active = threading.active_count()
-        while active > 1:
-            time.sleep(0.5)
-            active = threading.active_count()
+class XMLTrackStream(object):
+    """
+    Incremental writer for soundforest XML track lists.
+
+    Tracks are written to the stream as they are appended, instead of
+    collecting the whole document to memory like XMLTrackTree.
+    """
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream
+        self.started = False
+
+    def write(self, data):
+        self.stream.write(data)
+        self.stream.flush()
+
+    def start(self):
+        self.write('<soundforest>\n  <tracks>\n')
+        self.started = True
+
+    def append(self, xmltags):
+        if not self.started:
+            self.start()
+        self.write(''.join('    %s\n' % line for line in xmltags.toxml().splitlines()))
+
+    def close(self):
+        if not self.started:
+            self.start()
+        self.write('  </tracks>\n</soundforest>\n')
 
 
 class MusaTagsEditor(ScriptThread):
@@ -117,31 +388,101 @@ class MusaScriptCommand(ScriptCommand):
     """
     Parent class for musa cli subcommands
     """
+    tag_cache_lock = threading.Lock()
+
+    @property
+    def tag_cache(self):
+        """
+        Tag cache, opened on first use
+        """
+        with self.tag_cache_lock:
+            if getattr(self, '_tag_cache', None) is None:
+                self._tag_cache = TagCache()
+            return self._tag_cache
 
-    def get_tags(self, track):
+    def get_tags(self, track, cached=False):
+        """
+        Return tags for track. With cached, read only tags are returned from
+        tag cache when the file is not modified after caching, and parsed
+        tags are stored to the cache.
+        """
         if isinstance(track, Track):
+            if cached:
+                try:
+                    tags = self.tag_cache.get(os.path.realpath(track.path))
+                    if tags is not None:
+                        return tags
+                except TagCacheError, emsg:
+                    self.log.debug(emsg)
+
             try:
-                return track.tags
+                tags = track.tags
 
             except TreeError, emsg:
                 self.log.debug('Error parsing tags from %s: %s' % (track.path, emsg))
                 return None
 
+            if cached and tags is not None:
+                try:
+                    self.tag_cache.store(os.path.realpath(track.path), tags)
+                except TagCacheError, emsg:
+                    self.log.debug(emsg)
+
+            return tags
+
         return None
 
+    def invalidate_tags(self, track):
+        """
+        Remove cached tags of track modified by musa
+        """
+        try:
+            self.tag_cache.invalidate(os.path.realpath(track.path))
+        except TagCacheError, emsg:
+            self.log.debug(emsg)
+
     def get_codec(self, codec):
         return match_codec(codec)
 
-    def process_tracks(self, trees, tracks, command, **kwargs):
+    def iterate_tracks(self, trees, tracks):
         """
-        Execute command for all tracks in trees or track list
+        Iterate all tracks in trees and track list
         """
         for tree in trees:
             for track in tree:
-                command(track=track, **kwargs)
+                yield track
 
         for track in tracks:
-            command(track=track, **kwargs)
+            yield track
+
+    def process_tracks(self, trees, tracks, command, threads=None, callback=None, **kwargs):
+        """
+        Execute command for all tracks in trees or track list
+
+        With threads > 1 the command is run in a pool of worker threads.
+        Results are passed to callback(track, result) in main thread, in
+        track order. Errors are reported per track and do not stop
+        processing. Returns number of tracks with errors.
+        """
+        def run_command(track):
+            return command(track=track, **kwargs)
+
+        errors = 0
+        if threads is None or threads <= 1:
+            results = (run_track(run_command, track) for track in self.iterate_tracks(trees, tracks))
+        else:
+            results = ordered_map(run_command, self.iterate_tracks(trees, tracks), threads)
+
+        for track, result, error in results:
+            if error is not None:
+                self.script.error('%s: %s' % (track.path, error))
+                errors += 1
+                continue
+
+            if callback is not None:
+                callback(track, result)
+
+        return errors
 
     def read_input_to_dict(self, fd):
         tags = {}
@@ -172,10 +513,12 @@ class MusaScriptCommand(ScriptCommand):
         if skip_targets:
             return [], [], []
 
+        walker_threads = int(self.script.db.get('walker_threads') or DEFAULT_WALKER_THREADS)
+
         trees, tracks, metadata = [], [], []
         for path in args.paths:
             if os.path.isdir(path):
-                trees.append(Tree(path))
+                trees.append(MusaTree(path, walker_threads))
 
             else:
                 try:
@@ -185,12 +528,8 @@ class MusaScriptCommand(ScriptCommand):
                     if match is not None:
                         metadata.append(match)
 
-        tracks_found = False
-        for d in trees:
-            if not len(d):
-                continue
-            tracks_found = True
-            break
+        # Stops walking trees at first track found
+        tracks_found = any(tree.has_tracks() for tree in trees)
 
         if not tracks_found and not len(tracks) and not len(metadata):
             return [], [], []
@@ -0,0 +1,369 @@
+# coding=utf-8
+"""Database updates
+
+Batched and incremental updates of tracks in configuration database
+
+"""
+
+import os
+
+from sqlalchemy import or_, true
+from sqlalchemy.exc import SQLAlchemyError
+
+from musa import MusaError
+from musa.cli import ordered_map
+from musa.search import SearchError
+from soundforest import normalized
+from soundforest.formats import match_codec
+from soundforest.log import SoundforestLogger
+from soundforest.models import AlbumModel, TrackModel, TagModel
+from soundforest.tree import Track, TreeError
+
+# Default number of tracks to update in one transaction
+DEFAULT_BATCH_SIZE = 500
+
+
+def tag_models(track_id, tags):
+    """
+    Return TagModel rows for track tags, one row for each value of
+    multi-valued tags
+    """
+    models = []
+    for tag, values in tags.items():
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        for value in values:
+            models.append(TagModel(track_id=track_id, tag=tag, value=value))
+    return models
+
+
+def update_index(index, log, tracks=(), removed=()):
+    """
+    Update search index entries after database changes. Database is already
+    committed, so failures are only logged and the index is marked to be
+    rebuilt before next search. Returns False if update failed.
+    """
+    try:
+        index.update(tracks, removed)
+        return True
+    except SearchError, emsg:
+        log.warning('Search index not updated: %s' % emsg)
+
+    try:
+        index.invalidate()
+    except SearchError, emsg:
+        log.warning('Error marking search index for rebuild: %s' % emsg)
+    return False
+
+
+class TrackUpdateBatch(list):
+    """
+    Collects modified tracks and writes their tags to database in batches.
+
+    Database tracks for the whole batch are looked up with one query and
+    the tags and track mtimes replaced in one transaction. With batch_size 0 tracks are only
+    written when flush() is called. If a search index is given, it is
+    updated after each batch until an update fails.
+    """
+    def __init__(self, db, batch_size=DEFAULT_BATCH_SIZE, index=None):
+        list.__init__(self)
+        self.log = SoundforestLogger().default_stream
+        self.db = db
+        self.batch_size = batch_size
+        self.index = index
+        self.updated = 0
+
+    def append(self, track):
+        list.append(self, track)
+        if self.batch_size and len(self) >= self.batch_size:
+            self.flush()
+
+    def lookup(self, tracks):
+        """
+        Return (database track, track) tuples for tracks found in database
+        """
+        paths = dict((track.path, track) for track in tracks)
+        directories = set(os.path.dirname(path) for path in paths.keys())
+
+        matches = []
+        directories = list(directories)
+        # Stay within SQLite limit of variables in one query
+        for i in range(0, len(directories), DEFAULT_BATCH_SIZE):
+            query = self.db.session.query(TrackModel).filter(
+                TrackModel.directory.in_(directories[i:i+DEFAULT_BATCH_SIZE])
+            )
+            for db_track in query:
+                if db_track.path in paths:
+                    matches.append((db_track, paths[db_track.path]))
+
+        return matches
+
+    def flush(self):
+        """
+        Write tags of collected tracks to database in one transaction
+        """
+        if not len(self):
+            return 0
+
+        tracks = self[:]
+        del self[:]
+
+        session = self.db.session
+        try:
+            matches = self.lookup(tracks)
+            for i in range(0, len(matches), DEFAULT_BATCH_SIZE):
+                ids = [db_track.id for db_track, track in matches[i:i+DEFAULT_BATCH_SIZE]]
+                session.query(TagModel).filter(
+                    TagModel.track_id.in_(ids)
+                ).delete(synchronize_session=False)
+
+            for db_track, track in matches:
+                session.add_all(tag_models(db_track.id, track.tags))
+                # Edited tracks are not parsed again by incremental updates
+                try:
+                    db_track.mtime = int(os.stat(track.path).st_mtime)
+                except OSError:
+                    pass
+
+            session.commit()
+
+        except SQLAlchemyError, emsg:
+            session.rollback()
+            raise MusaError('Error updating database: %s' % emsg)
+
+        if self.index is not None:
+            indexed = update_index(self.index, self.log, [
+                (db_track.id, db_track.tree_id, track.path, dict(track.tags.items()))
+                for db_track, track in matches
+            ])
+            if not indexed:
+                self.index = None
+
+        self.updated += len(matches)
+        return len(matches)
+
+
+class TreeUpdater(object):
+    """
+    Incremental update of database tree from filesystem.
+
+    Stored album directory and track file mtimes are compared to the
+    filesystem, and tags are only parsed for new and modified tracks. With
+    quick, albums with unchanged directory mtime are skipped without
+    checking their tracks: this misses tags edited in place, which does not
+    change directory mtime. With full, tags of all tracks are parsed again.
+
+    If directories are given, only these directories and directories below
+    them are updated. If a search index is given, added, modified and
+    removed tracks are updated to the index after database is updated.
+    """
+    def __init__(self, db, db_tree, threads=1, quick=False, full=False,
+                 batch_size=DEFAULT_BATCH_SIZE, directories=None, index=None):
+        self.log = SoundforestLogger().default_stream
+        self.db = db
+        self.db_tree = db_tree
+        self.directories = None
+        if directories is not None:
+            self.directories = self.top_directories(directories)
+        self.threads = threads
+        self.quick = quick
+        self.full = full
+        self.batch_size = batch_size
+        self.index = index
+        self.indexed = []
+        self.removed_ids = []
+        self.added = 0
+        self.changed = 0
+        self.removed = 0
+        self.errors = 0
+
+    def top_directories(self, directories):
+        """
+        Return sorted directories, without directories below other directories
+        """
+        top = []
+        for directory in sorted(normalized(d.rstrip(os.sep)) for d in directories):
+            if top and (directory == top[-1] or directory.startswith(top[-1] + os.sep)):
+                continue
+            top.append(directory)
+        return top
+
+    def in_scope(self, directory):
+        """
+        Check if directory is updated
+        """
+        if self.directories is None:
+            return True
+        for top in self.directories:
+            if directory == top or directory.startswith(top + os.sep):
+                return True
+        return False
+
+    def scope_filter(self, column):
+        """
+        Return query filter for directory column to match updated directories
+        """
+        if self.directories is None:
+            return true()
+
+        def escaped(value):
+            # Directory names may contain LIKE wildcards
+            return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+        return or_(*[
+            (column == d) | column.like('%s%s%%' % (escaped(d), os.sep), escape='\\')
+            for d in self.directories
+        ])
+
+    def scan(self):
+        """
+        Yield (directory, mtime, filenames) for directories with audio files
+        """
+        if self.directories is None:
+            paths = [self.db_tree.path]
+        else:
+            paths = [d for d in self.directories if os.path.isdir(d)]
+
+        for path in paths:
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                filenames = sorted(f for f in files if match_codec(f) is not None)
+                if not filenames:
+                    continue
+                try:
+                    mtime = int(os.stat(root).st_mtime)
+                except OSError:
+                    continue
+                yield normalized(root), mtime, filenames
+
+    def modified_tracks(self, db_albums, db_tracks):
+        """
+        Yield (db_album, track, db_track, mtime) for new and modified tracks,
+        removing deleted tracks and albums from the session.
+        """
+        seen_albums = set()
+        for directory, mtime, filenames in self.scan():
+            seen_albums.add(directory)
+            db_album = db_albums.get(directory)
+
+            if db_album is None:
+                db_album = AlbumModel(tree=self.db_tree, directory=directory, mtime=mtime)
+                self.db.session.add(db_album)
+
+            elif db_album.mtime == mtime and self.quick and not self.full:
+                continue
+
+            else:
+                db_album.mtime = mtime
+
+            existing = db_tracks.get(directory, {})
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    track_mtime = int(os.stat(path).st_mtime)
+                except OSError:
+                    continue
+
+                db_track = existing.pop(normalized(filename), None)
+                if db_track is not None and db_track.mtime == track_mtime and not self.full:
+                    continue
+
+                try:
+                    track = Track(path)
+                except TreeError:
+                    continue
+                yield db_album, track, db_track, track_mtime
+
+            for db_track in existing.values():
+                self.log.debug('Removing track: %s' % db_track.path)
+                self.removed_ids.append(db_track.id)
+                self.db.session.delete(db_track)
+                self.removed += 1
+
+        for directory, db_album in db_albums.items():
+            if directory in seen_albums or not self.in_scope(directory):
+                continue
+            self.log.debug('Removing album: %s' % directory)
+            self.removed += len(db_tracks.get(directory, {}))
+            self.removed_ids.extend(t.id for t in db_tracks.get(directory, {}).values())
+            self.db.session.delete(db_album)
+
+    def update(self):
+        """
+        Update tree, returning (added, changed, removed) counters
+        """
+        session = self.db.session
+
+        db_albums = {}
+        query = session.query(AlbumModel).filter(
+            AlbumModel.tree_id == self.db_tree.id,
+            self.scope_filter(AlbumModel.directory)
+        )
+        for db_album in query:
+            db_albums[db_album.directory] = db_album
+
+        db_tracks = {}
+        query = session.query(TrackModel).filter(
+            TrackModel.tree_id == self.db_tree.id,
+            self.scope_filter(TrackModel.directory)
+        )
+        for db_track in query:
+            db_tracks.setdefault(db_track.directory, {})[db_track.filename] = db_track
+
+        def load_tags(entry):
+            return entry[1].tags
+
+        try:
+            pending = 0
+            entries = self.modified_tracks(db_albums, db_tracks)
+            for entry, tags, error in ordered_map(load_tags, entries, max(self.threads, 1)):
+                db_album, track, db_track, mtime = entry
+                if error is not None or tags is None:
+                    self.log.debug('Error loading tags from %s: %s' % (track.path, error))
+                    self.errors += 1
+                    continue
+
+                if db_track is None:
+                    db_track = TrackModel(
+                        tree=self.db_tree,
+                        album=db_album,
+                        directory=track.directory,
+                        filename=track.filename,
+                        extension=track.extension,
+                        mtime=mtime,
+                        deleted=False,
+                    )
+                    session.add(db_track)
+                    session.flush()
+                    self.added += 1
+
+                else:
+                    db_track.mtime = mtime
+                    session.query(TagModel).filter(
+                        TagModel.track_id == db_track.id
+                    ).delete(synchronize_session=False)
+                    self.changed += 1
+
+                session.add_all(tag_models(db_track.id, tags))
+
+                if self.index is not None:
+                    self.indexed.append((db_track.id, self.db_tree.id, track.path, dict(tags.items())))
+
+                # Flush instead of commit to not expire loaded albums and tracks
+                pending += 1
+                if self.batch_size and pending >= self.batch_size:
+                    session.flush()
+                    pending = 0
+
+            session.commit()
+
+        except SQLAlchemyError, emsg:
+            session.rollback()
+            raise MusaError('Error updating database tree %s: %s' % (self.db_tree.path, emsg))
+
+        if self.index is not None:
+            update_index(self.index, self.log, self.indexed, self.removed_ids)
+            self.indexed = []
+            self.removed_ids = []
+
+        return self.added, self.changed, self.removed
@@ -15,7 +15,17 @@ else:
     MUSA_USER_DIR = os.path.expanduser('~/.config/musa')
     MUSA_CACHE_DIR = os.path.expanduser('~/.cache/musa')
 
+# Permissions of transcoded files, as created by encoders with user umask
+_umask = os.umask(0)
+os.umask(_umask)
+TARGET_FILE_MODE = 0666 & ~_umask
+
 # Default settings for empty database
+#
+# Other settings read from configuration database, set with 'musa config set':
+#   executor                threads or processes, default musa.cli.DEFAULT_EXECUTOR
+#   walker_threads          directory listing threads, default musa.walker.DEFAULT_WALKER_THREADS
+#   transcode_cache_size    megabytes, default musa.cache.DEFAULT_TRANSCODE_CACHE_SIZE
 INITIAL_SETTINGS = {
     'threads':  4,
     'default_codec': 'mp3',
@@ -0,0 +1,362 @@
+# coding=utf-8
+"""Bulk rename
+
+Journaled renaming of many files at once. All moves are planned and checked
+for collisions before any file is renamed, moves forming cycles are staged
+through temporary names, and completed operations are written to a journal
+so interrupted runs can be resumed or rolled back.
+
+"""
+
+import os
+import json
+import time
+
+from datetime import datetime
+
+from musa.defaults import MUSA_CACHE_DIR
+
+RENAME_JOURNAL_DIR = os.path.join(MUSA_CACHE_DIR, 'renames')
+JOURNAL_EXTENSION = '.journal'
+
+# Prefix for names of files staged to break rename cycles
+STAGING_PREFIX = '.musa-rename-'
+
+
+class RenameError(Exception):
+    pass
+
+
+def path_below(root, path):
+    """
+    Return relative path joined to root. Raises RenameError if a path
+    component is empty, '.' or '..', or if the result is not below root.
+    """
+    for component in path.split(os.sep):
+        if component in ('', '.', '..'):
+            raise RenameError('Invalid path component "%s" in %s' % (component, path))
+
+    root = os.path.abspath(root)
+    target = os.path.normpath(os.path.join(root, path))
+    if not target.startswith(root.rstrip(os.sep) + os.sep):
+        raise RenameError('Path %s is not below %s' % (path, root))
+    return target
+
+
+class RenamePlan(object):
+    """
+    Ordered list of operations to rename files from source to target paths.
+
+    Operations are ('mkdir', None, path) or ('rename', src, dst) tuples. A
+    move to a path which is the source of another move is ordered after that
+    move. In cycles of moves, one file is first renamed to a temporary name.
+
+    Raises RenameError if sources are missing or listed twice, or if a
+    target is listed twice or is an existing file not renamed by the plan.
+    """
+    def __init__(self, moves, token=None):
+        self.token = token is not None and token or '%x-%d' % (int(time.time()*1000), os.getpid())
+        self.moves = []
+        self.cycles = 0
+        self.operations = []
+
+        sources = {}
+        targets = {}
+        for src, dst in moves:
+            src = os.path.abspath(src)
+            dst = os.path.abspath(dst)
+            if src == dst:
+                continue
+
+            if src in sources:
+                raise RenameError('Source renamed twice: %s' % src)
+            if dst in targets:
+                raise RenameError('Target collision: %s and %s renamed to %s' % (targets[dst], src, dst))
+            if not os.path.lexists(src):
+                raise RenameError('No such file: %s' % src)
+
+            sources[src] = dst
+            targets[dst] = src
+            self.moves.append((src, dst))
+
+        for src, dst in self.moves:
+            # Renames changing only case of name on case insensitive filesystems are allowed
+            if dst not in sources and os.path.lexists(dst) and not os.path.samefile(src, dst):
+                raise RenameError('Target exists: %s' % dst)
+
+        self.plan(sources, targets)
+
+    def __len__(self):
+        return len(self.moves)
+
+    def staging_path(self, src, index):
+        return os.path.join(os.path.dirname(src), '%s%s-%d' % (STAGING_PREFIX, self.token, index))
+
+    def plan(self, sources, targets):
+        """
+        Order moves to operations
+        """
+        directories = set()
+        for src, dst in sorted(self.moves):
+            directory = os.path.dirname(dst)
+            while directory not in directories and not os.path.isdir(directory):
+                directories.add(directory)
+                directory = os.path.dirname(directory)
+        for directory in sorted(directories):
+            self.operations.append(('mkdir', None, directory))
+
+        # Each target is the source of at most one other move, so moves form
+        # separate chains and cycles. Chains are renamed starting from end.
+        done = set()
+        for src, dst in sorted(self.moves):
+            if src in targets:
+                continue
+            chain = []
+            while src is not None:
+                chain.append((src, sources[src]))
+                done.add(src)
+                src = sources[src] in sources and sources[src] or None
+            self.operations.extend(('rename', s, d) for s, d in reversed(chain))
+
+        # Remaining moves are in cycles: first file in each cycle is staged
+        # to free its name, rest of the cycle is then a chain.
+        for src, dst in sorted(self.moves):
+            if src in done:
+                continue
+            cycle = []
+            while src not in done:
+                cycle.append((src, sources[src]))
+                done.add(src)
+                src = sources[src]
+
+            staged = self.staging_path(cycle[0][0], self.cycles)
+            self.operations.append(('rename', cycle[0][0], staged))
+            self.operations.extend(('rename', s, d) for s, d in reversed(cycle[1:]))
+            self.operations.append(('rename', staged, cycle[0][1]))
+            self.cycles += 1
+
+
+class RenameJournal(object):
+    """
+    Executes rename plan operations, recording completed operations to a
+    journal file. Journal is removed when all operations are done or rolled
+    back.
+
+    Journal file has the operations as JSON on first line, followed by one
+    line with index of each completed operation, and 'undo <index>' lines
+    for operations rolled back.
+    """
+    def __init__(self, path, operations, completed=0):
+        self.path = path
+        self.operations = operations
+        self.completed = completed
+        self.fd = None
+
+    def __repr__(self):
+        return '%s: %d of %d operations completed' % (self.path, self.completed, len(self.operations))
+
+    @classmethod
+    def create(cls, plan, directory=RENAME_JOURNAL_DIR):
+        """
+        Write journal for plan
+        """
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, (ecode, emsg):
+                if not os.path.isdir(directory):
+                    raise RenameError('Error creating directory %s: %s' % (directory, emsg))
+
+        journal = cls(os.path.join(directory, '%s%s' % (plan.token, JOURNAL_EXTENSION)), plan.operations)
+        try:
+            with open(journal.path, 'w') as fd:
+                fd.write('%s\n' % json.dumps({
+                    'created': datetime.now().isoformat(),
+                    'operations': plan.operations,
+                }))
+                fd.flush()
+                os.fsync(fd.fileno())
+        except IOError, (ecode, emsg):
+            raise RenameError('Error writing journal %s: %s' % (journal.path, emsg))
+
+        return journal
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load journal of an interrupted run
+        """
+        try:
+            with open(path, 'r') as fd:
+                lines = [line.strip() for line in fd.read().splitlines() if line.strip()]
+            operations = [tuple(op) for op in json.loads(lines[0])['operations']]
+
+            completed = 0
+            if len(lines) > 1:
+                # Last line has the latest completed or undone operation
+                if lines[-1].startswith('undo '):
+                    completed = int(lines[-1][5:])
+                else:
+                    completed = int(lines[-1]) + 1
+
+        except (IOError, OSError), (ecode, emsg):
+            raise RenameError('Error reading journal %s: %s' % (path, emsg))
+        except (IndexError, ValueError, KeyError, TypeError):
+            raise RenameError('Invalid journal file: %s' % path)
+
+        return cls(path, operations, completed)
+
+    def is_done(self, operation):
+        """
+        Check if operation was done, for operation interrupted before it was
+        recorded to the journal
+        """
+        action, src, dst = operation
+        if action == 'mkdir':
+            return os.path.isdir(dst)
+        return not os.path.lexists(src) and os.path.lexists(dst)
+
+    def write(self, line):
+        if self.fd is None:
+            try:
+                self.fd = open(self.path, 'a')
+            except IOError, (ecode, emsg):
+                raise RenameError('Error writing journal %s: %s' % (self.path, emsg))
+        self.fd.write('%s\n' % line)
+        self.fd.flush()
+
+    def record(self, index):
+        """
+        Record operation as completed
+        """
+        self.write('%d' % index)
+        self.completed = index + 1
+
+    def record_undo(self, index):
+        """
+        Record completed operation as rolled back
+        """
+        self.write('undo %d' % index)
+        self.completed = index
+
+    def close(self, remove=False):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+        if remove and os.path.isfile(self.path):
+            os.unlink(self.path)
+
+    def run(self):
+        """
+        Run operations not yet completed and remove the journal.
+
+        Raises RenameError if an operation fails, leaving the journal to
+        resume or roll back the run.
+        """
+        try:
+            for index in range(self.completed, len(self.operations)):
+                action, src, dst = self.operations[index]
+                if index == self.completed and self.is_done(self.operations[index]):
+                    self.record(index)
+                    continue
+
+                try:
+                    if action == 'mkdir':
+                        if not os.path.isdir(dst):
+                            os.mkdir(dst)
+                    elif os.path.lexists(dst) and not os.path.samefile(src, dst):
+                        raise RenameError('Target exists: %s' % dst)
+                    else:
+                        os.rename(src, dst)
+                except OSError, (ecode, emsg):
+                    raise RenameError('Error renaming %s to %s: %s' % (src or '', dst, emsg))
+                self.record(index)
+
+        except RenameError:
+            self.close()
+            raise
+
+        self.close(remove=True)
+
+    def rollback(self):
+        """
+        Undo completed operations in reverse order and remove the journal
+        """
+        try:
+            if self.completed < len(self.operations) and self.is_done(self.operations[self.completed]):
+                self.record(self.completed)
+
+            for index in reversed(range(self.completed)):
+                action, src, dst = self.operations[index]
+                try:
+                    if action == 'mkdir':
+                        if os.path.isdir(dst) and not os.listdir(dst):
+                            os.rmdir(dst)
+                    elif os.path.lexists(dst) and not os.path.lexists(src):
+                        os.rename(dst, src)
+                except OSError, (ecode, emsg):
+                    raise RenameError('Error rolling back %s to %s: %s' % (dst, src or '', emsg))
+                self.record_undo(index)
+
+        except RenameError:
+            self.close()
+            raise
+
+        self.close(remove=True)
+
+
+def bulk_rename(moves, directory=RENAME_JOURNAL_DIR):
+    """
+    Rename files in moves, given as (source, target) tuples. If a rename
+    fails, completed renames are rolled back and RenameError is raised.
+
+    Returns the executed RenamePlan.
+    """
+    plan = RenamePlan(moves)
+    if not plan.operations:
+        return plan
+
+    journal = RenameJournal.create(plan, directory)
+    try:
+        journal.run()
+    except RenameError, emsg:
+        try:
+            journal.rollback()
+        except RenameError, rollback_error:
+            raise RenameError('%s. Rollback failed: %s, see %s' % (emsg, rollback_error, journal.path))
+        raise
+
+    return plan
+
+
+def remove_empty_directories(directories, roots):
+    """
+    Remove directories left empty by renames and their empty parents, up to
+    but not including roots. Directories not below roots are never removed.
+
+    Returns list of removed directories.
+    """
+    roots = [os.path.abspath(root) for root in roots]
+    removed = []
+    for directory in sorted(set(os.path.abspath(d) for d in directories), reverse=True):
+        while directory not in roots and [r for r in roots if directory.startswith(r + os.sep)]:
+            if not os.path.isdir(directory) or os.listdir(directory):
+                break
+            try:
+                os.rmdir(directory)
+            except OSError, (ecode, emsg):
+                raise RenameError('Error removing directory %s: %s' % (directory, emsg))
+            removed.append(directory)
+            directory = os.path.dirname(directory)
+
+    return removed
+
+
+def pending_journals(directory=RENAME_JOURNAL_DIR):
+    """
+    Return paths to journals of interrupted runs, oldest first
+    """
+    if not os.path.isdir(directory):
+        return []
+    paths = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(JOURNAL_EXTENSION)]
+    return sorted(paths, key=lambda path: os.stat(path).st_mtime)
@@ -0,0 +1,299 @@
+# coding=utf-8
+"""Track search index
+
+Full text index of database track tags, kept up to date when trees are
+updated to database
+
+"""
+
+import os
+import re
+import shlex
+import sqlite3
+import threading
+
+from datetime import datetime
+
+from musa.defaults import MUSA_CACHE_DIR
+from soundforest.models import TrackModel, TagModel
+
+SEARCH_INDEX_DB = os.path.join(MUSA_CACHE_DIR, 'search.sqlite')
+
+# Tags indexed to separate columns, usable as field:value in queries
+SEARCH_FIELDS = (
+    'artist',
+    'album',
+    'title',
+    'genre',
+)
+DEFAULT_SEARCH_LIMIT = 50
+
+# Number of ids in one query, to stay within SQLite limit of variables
+QUERY_BATCH_SIZE = 500
+
+RE_WORD = re.compile(r'\w+', re.UNICODE)
+
+# Index is recreated when stored schema version differs
+SCHEMA_VERSION = 1
+
+# Database track ids are stored as rowid, to look up rows by track id
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks USING fts5 (
+    tree_id UNINDEXED,
+    path UNINDEXED,
+    %s,
+    tags,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key         TEXT PRIMARY KEY,
+    value       TEXT
+);
+""" % ',\n    '.join(SEARCH_FIELDS)
+
+DROP_SCHEMA = """
+DROP TABLE IF EXISTS tracks;
+DROP TABLE IF EXISTS meta;
+"""
+
+
+class SearchError(Exception):
+    pass
+
+
+def existing_index(path=SEARCH_INDEX_DB):
+    """
+    Return SearchIndex for path if the index has been created and can be
+    opened, otherwise None. A missing index is built by the first search.
+    """
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        index = SearchIndex(path)
+        index.connection
+    except SearchError:
+        return None
+    return index
+
+
+class SearchIndex(object):
+    """
+    SQLite FTS5 index of track tags in MUSA_CACHE_DIR.
+
+    Tags listed in SEARCH_FIELDS are stored to their own columns, values of
+    other tags to one shared column. Rows are keyed by database track id.
+    """
+    def __init__(self, path=SEARCH_INDEX_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.__connection = None
+
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, (ecode, emsg):
+                if not os.path.isdir(directory):
+                    raise SearchError('Error creating directory %s: %s' % (directory, emsg))
+
+    @property
+    def connection(self):
+        if self.__connection is None:
+            try:
+                connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+                version = connection.execute('PRAGMA user_version').fetchone()[0]
+                if version != SCHEMA_VERSION:
+                    connection.executescript(DROP_SCHEMA)
+                connection.executescript(SCHEMA)
+                connection.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+                self.__connection = connection
+            except sqlite3.Error, emsg:
+                raise SearchError('Error opening search index %s: %s' % (self.path, emsg))
+        return self.__connection
+
+    def __len__(self):
+        with self.lock:
+            c = self.connection.cursor()
+            c.execute('SELECT COUNT(*) FROM tracks')
+            return c.fetchone()[0]
+
+    @property
+    def built(self):
+        """
+        True if index has been built from all database tracks. Index updated
+        only with modified tracks before that is incomplete.
+        """
+        with self.lock:
+            try:
+                c = self.connection.cursor()
+                c.execute("SELECT value FROM meta WHERE key='built'")
+                return c.fetchone() is not None
+            except sqlite3.Error, emsg:
+                raise SearchError('Error reading search index: %s' % emsg)
+
+    def invalidate(self):
+        """
+        Mark index not built, so it is rebuilt before next search
+        """
+        with self.lock:
+            try:
+                self.connection.execute("DELETE FROM meta WHERE key='built'")
+                self.connection.commit()
+            except sqlite3.Error, emsg:
+                raise SearchError('Error updating search index: %s' % emsg)
+
+    def row(self, track_id, tree_id, path, tags):
+        """
+        Return index table row for track tags dictionary
+        """
+        fields = dict((field, []) for field in SEARCH_FIELDS)
+        other = []
+        for tag, value in tags.items():
+            if isinstance(value, (list, tuple)):
+                value = u' '.join(value)
+            fields.get(tag, other).append(value)
+
+        return [track_id, tree_id, path] + \
+            [u' '.join(fields[field]) for field in SEARCH_FIELDS] + \
+            [u' '.join(other)]
+
+    def delete(self, cursor, track_ids):
+        track_ids = list(track_ids)
+        for i in range(0, len(track_ids), QUERY_BATCH_SIZE):
+            ids = track_ids[i:i+QUERY_BATCH_SIZE]
+            cursor.execute(
+                'DELETE FROM tracks WHERE rowid IN (%s)' % ','.join('?' for x in ids), ids
+            )
+
+    def update(self, tracks=(), removed=()):
+        """
+        Replace index entries for tracks, given as (track_id, tree_id, path,
+        tags) tuples, and remove entries for removed track ids.
+        """
+        tracks = list(tracks)
+        with self.lock:
+            try:
+                c = self.connection.cursor()
+                self.delete(c, list(removed) + [track[0] for track in tracks])
+                c.executemany(
+                    'INSERT INTO tracks (rowid, tree_id, path, %s, tags) VALUES (%s)' % (
+                        ', '.join(SEARCH_FIELDS), ','.join('?' for x in range(len(SEARCH_FIELDS)+4))
+                    ),
+                    [self.row(*track) for track in tracks]
+                )
+                self.connection.commit()
+
+            except sqlite3.Error, emsg:
+                self.connection.rollback()
+                raise SearchError('Error updating search index: %s' % emsg)
+
+    def remove_tree(self, tree_id):
+        """
+        Remove index entries for tree
+        """
+        with self.lock:
+            try:
+                self.connection.execute('DELETE FROM tracks WHERE tree_id=?', (tree_id, ))
+                self.connection.commit()
+            except sqlite3.Error, emsg:
+                raise SearchError('Error updating search index: %s' % emsg)
+
+    def rebuild(self, db):
+        """
+        Rebuild index from all track tags in database, marking the index
+        built
+        """
+        query = db.session.query(
+            TrackModel.id, TrackModel.tree_id, TrackModel.directory, TrackModel.filename,
+            TagModel.tag, TagModel.value
+        ).filter(TagModel.track_id == TrackModel.id).order_by(TrackModel.id)
+
+        tracks = {}
+        for track_id, tree_id, directory, filename, tag, value in query:
+            if track_id not in tracks:
+                tracks[track_id] = (track_id, tree_id, os.path.join(directory, filename), {})
+            tracks[track_id][3].setdefault(tag, []).append(value)
+
+        with self.lock:
+            try:
+                self.connection.execute('DELETE FROM tracks')
+                self.connection.execute("DELETE FROM meta WHERE key='built'")
+                self.connection.commit()
+            except sqlite3.Error, emsg:
+                raise SearchError('Error updating search index: %s' % emsg)
+        self.update(tracks.values())
+
+        with self.lock:
+            try:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('built', ?)",
+                    (datetime.now().isoformat(), )
+                )
+                self.connection.commit()
+            except sqlite3.Error, emsg:
+                raise SearchError('Error updating search index: %s' % emsg)
+
+        return len(tracks)
+
+    def parse_query(self, query):
+        """
+        Parse query to FTS5 match expression.
+
+        Words in query are matched as prefixes in all columns, and field:value
+        matches value in given field only. Quoted values are matched as
+        phrases.
+        """
+        if isinstance(query, unicode):
+            query = query.encode('utf-8')
+        try:
+            tokens = shlex.split(query)
+        except ValueError, emsg:
+            raise SearchError('Error parsing query %s: %s' % (query, emsg))
+
+        terms = []
+        for token in tokens:
+            token = unicode(token, 'utf-8')
+            field = None
+            if ':' in token:
+                name, value = token.split(':', 1)
+                if name.lower() in SEARCH_FIELDS:
+                    field, token = name.lower(), value
+
+            words = RE_WORD.findall(token)
+            if not words:
+                continue
+
+            phrase = u'"%s"*' % u' '.join(words)
+            if field is not None:
+                phrase = u'%s : %s' % (field, phrase)
+            terms.append(phrase)
+
+        return u' AND '.join(terms)
+
+    def search(self, query, limit=DEFAULT_SEARCH_LIMIT, tree_ids=None):
+        """
+        Return (track_id, path) tuples for tracks matching query, best
+        matches first
+        """
+        expression = self.parse_query(query)
+        if not expression:
+            return []
+
+        sql = 'SELECT rowid, path FROM tracks WHERE tracks MATCH ?'
+        args = [expression]
+        if tree_ids:
+            sql += ' AND tree_id IN (%s)' % ','.join('?' for x in tree_ids)
+            args.extend(tree_ids)
+        sql += ' ORDER BY rank'
+        if limit:
+            sql += ' LIMIT ?'
+            args.append(limit)
+
+        with self.lock:
+            try:
+                c = self.connection.cursor()
+                c.execute(sql, args)
+                return c.fetchall()
+            except sqlite3.Error, emsg:
+                raise SearchError('Error searching %s: %s' % (query, emsg))
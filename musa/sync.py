@@ -6,16 +6,23 @@ Parsing of syncing options
 """
 
 import os
+import re
+import select
 import shutil
+import hashlib
+import json
 import time
 
 from subprocess import Popen, PIPE
 
 from musa.defaults import MUSA_USER_DIR
 from musa.cli import ScriptThread, MusaThreadManager
+from musa.walker import MusaTree, TreeWalker, DEFAULT_WALKER_THREADS
+from soundforest import normalized
+from soundforest.formats import match_codec
 from soundforest.config import ConfigDB
 from soundforest.log import SoundforestLogger
-from soundforest.tree import Tree, Track, TreeError
+from soundforest.tree import Tree
 
 SYNC_LOG = os.path.join(MUSA_USER_DIR, 'sync.log')
 
@@ -30,6 +37,29 @@ RSYNC_DELETE_FLAGS = (
 )
 DEFAULT_DELETE_FLAG = '--delete-before'
 
+RSYNC_PROGRESS_FLAGS = (
+    '--info=progress2',
+    '--stats',
+)
+RE_RSYNC_PROGRESS = re.compile(
+    r'^\s*(?P<bytes>[0-9,]+)\s+(?P<percent>[0-9]+)%\s+(?P<rate>[0-9.]+[kMGT]?B/s)\s+(?P<eta>[0-9:]+)'
+    r'(\s+\(xfr#(?P<files>[0-9]+), [a-z]+-chk=(?P<remaining>[0-9]+)/(?P<total>[0-9]+)\))?'
+)
+RE_RSYNC_STATS = re.compile(
+    r'^(?P<key>Number of [a-z ]*files[a-z ]*|Total [a-z ]*size|Total bytes [a-z]+): (?P<value>[0-9,]+)'
+)
+
+# Directory sync track change detection modes
+COMPARE_MODES = (
+    'size',
+    'mtime',
+    'checksum',
+)
+CHECKSUM_BLOCK_SIZE = 65536
+
+# Directory sync manifest filename in destination root
+SYNC_MANIFEST = '.musa-sync.json'
+
 class SyncError(Exception):
     pass
 
@@ -57,18 +87,20 @@ RENAME_CALLBACKS = {
 }
 
 class SyncThread(ScriptThread):
-    def __init__(self, manager, index, src, dst, delete=False):
+    def __init__(self, manager, index, src, dst, delete=False, dry_run=False):
         ScriptThread.__init__(self, 'sync')
         self.manager = manager
         self.index = index
         self.delete = delete
+        self.dry_run = dry_run
+        self.walker_threads = manager.walker_threads
 
         if isinstance(src, Tree):
             self.src_tree = src
             self.src = src.path
 
         elif isinstance(src, basestring):
-            self.src_tree = Tree(src)
+            self.src_tree = MusaTree(src, self.walker_threads)
             self.src = os.path.expandvars(src).rstrip(os.sep)
 
         else:
@@ -79,7 +111,7 @@ class SyncThread(ScriptThread):
             self.dst = dst.path
 
         elif isinstance(dst, basestring):
-            self.dst_tree = Tree(dst)
+            self.dst_tree = MusaTree(dst, self.walker_threads)
             self.dst = os.path.expandvars(dst).rstrip(os.sep)
 
         else:
@@ -88,9 +120,97 @@ class SyncThread(ScriptThread):
     def run(self):
         raise NotImplementedError('Must be implemented in inheriting class')
 
+class SyncManifest(dict):
+    """
+    Directory sync manifest stored in destination root.
+
+    Maps source relative paths to destination relative path and source
+    size and mtime of the track when it was last synced.
+    """
+    def __init__(self, path):
+        dict.__init__(self)
+        self.path = os.path.join(path, SYNC_MANIFEST)
+
+    def load(self):
+        self.clear()
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'r') as fd:
+                self.update(json.load(fd))
+        except (IOError, ValueError):
+            # Invalid manifest only causes a full rescan
+            self.clear()
+
+    def save(self, entries):
+        """
+        Write manifest entries via temporary file
+        """
+        tmp = '%s.tmp' % self.path
+        try:
+            with open(tmp, 'w') as fd:
+                json.dump(entries, fd)
+            os.rename(tmp, self.path)
+        except (IOError, OSError), (ecode, emsg):
+            raise SyncError('Error writing sync manifest %s: %s' % (self.path, emsg))
+
+        self.clear()
+        self.update(entries)
+
+
+class TrackCopyThread(ScriptThread):
+    """
+    Copy one track from FilesystemSyncThread copy queue
+    """
+    def __init__(self, manager, index, src, dst, preserve_mtime=False):
+        ScriptThread.__init__(self, 'sync-copy')
+        self.manager = manager
+        self.index = index
+        self.src = src
+        self.dst = dst
+        self.preserve_mtime = preserve_mtime
+
+    def run(self):
+        self.status = 'copying'
+        try:
+            shutil.copyfile(self.src, self.dst)
+            if self.preserve_mtime:
+                shutil.copystat(self.src, self.dst)
+
+        except IOError, (ecode, emsg):
+            raise SyncError('Error writing to %s: %s' % (self.dst, emsg))
+
+        except OSError, (ecode, emsg):
+            raise SyncError('Error writing to %s: %s' % (self.dst, emsg))
+
+        self.manager.copied(os.stat(self.dst).st_size)
+        self.status = 'finished'
+
+
+class TrackCopyManager(MusaThreadManager):
+    """
+    Copies tracks with a pool of workers and counts copied data
+    """
+    def __init__(self, threads=None, preserve_mtime=False):
+        MusaThreadManager.__init__(self, 'sync-copy', threads, executor='threads')
+        self.preserve_mtime = preserve_mtime
+        self.files = 0
+        self.bytes = 0
+
+    def copied(self, size):
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+
+    def get_entry_handler(self, index, entry):
+        src, dst = entry
+        return TrackCopyThread(self, index, src, dst, self.preserve_mtime)
+
+
 class FilesystemSyncThread(SyncThread):
-    def __init__(self, manager, index, src, dst, delete=False, rename=None):
-        SyncThread.__init__(self, manager, index, src, dst, delete)
+    def __init__(self, manager, index, src, dst, delete=False, dry_run=False, rename=None,
+                 compare='size', copy_threads=None, verify=False):
+        SyncThread.__init__(self, manager, index, src, dst, delete, dry_run)
 
         if rename is not None:
             try:
@@ -98,17 +218,98 @@ class FilesystemSyncThread(SyncThread):
             except KeyError:
                 raise SyncError('Unknown rename callback: %s' % rename)
 
+        if compare not in COMPARE_MODES:
+            raise SyncError('Unknown compare mode: %s' % compare)
+
         self.rename = rename
+        self.compare = compare
+        self.copy_threads = copy_threads
+        self.verify = verify
+
+    def checksum(self, path, size):
+        """
+        Fast checksum from beginning and end of the file, where the tags are
+        """
+        checksum = hashlib.sha1()
+        with open(path, 'rb') as fd:
+            checksum.update(fd.read(CHECKSUM_BLOCK_SIZE))
+            if size > CHECKSUM_BLOCK_SIZE:
+                fd.seek(max(CHECKSUM_BLOCK_SIZE, size-CHECKSUM_BLOCK_SIZE))
+                checksum.update(fd.read(CHECKSUM_BLOCK_SIZE))
+        return checksum.hexdigest()
+
+    def is_modified(self, src_stat, src_path, dst_stat, dst_path):
+        """
+        Check if source track differs from destination with compare mode
+        """
+        if src_stat.st_size != dst_stat.st_size:
+            return True
+
+        if self.compare == 'mtime':
+            # Allow FAT filesystem 2 second timestamp resolution
+            return abs(src_stat.st_mtime - dst_stat.st_mtime) > 2
+
+        if self.compare == 'checksum':
+            try:
+                return self.checksum(src_path, src_stat.st_size) != self.checksum(dst_path, dst_stat.st_size)
+            except IOError, (ecode, emsg):
+                self.log.info('Error reading %s: %s' % (dst_path, emsg))
+                return True
 
-    def copy_track(self, src, dst):
-        try:
-            shutil.copyfile(src, dst)
+        return False
 
-        except IOError, (ecode, emsg):
-            raise SyncError('Error writing to %s: %s' % (dst, emsg))
+    def remove_stale(self, manifest, expected):
+        """
+        Remove destination tracks not in expected relative paths, and album
+        directories left empty.
 
-        except OSError, (ecode, emsg):
-            raise SyncError('Error writing to %s: %s' % (dst, emsg))
+        Stale tracks are looked up from previous sync manifest, or by
+        walking the destination tree if there is no manifest or verify is set.
+        """
+        dst = self.dst_tree.path
+
+        if manifest and not self.verify:
+            stale = set(entry['path'] for entry in manifest.values()).difference(expected)
+
+        else:
+            stale = set()
+            for root, dirs, files in TreeWalker(dst, self.walker_threads).walk():
+                for name in files:
+                    if match_codec(name) is None:
+                        continue
+                    path = normalized(os.path.relpath(os.path.join(root, name), dst))
+                    if path not in expected:
+                        stale.add(path)
+
+        directories = set()
+        for path in sorted(stale):
+            path = os.path.join(dst, path)
+            if not os.path.isfile(path):
+                continue
+
+            if self.dry_run:
+                self.log.info('Remove (dry run): %s' % path)
+                continue
+
+            self.log.info('Remove: %s' % path)
+            try:
+                os.unlink(path)
+                directories.add(os.path.dirname(path))
+            except OSError, (ecode, emsg):
+                self.log.info('Error removing %s: %s' % (path, emsg))
+
+        # Remove deepest directories first, never the destination root
+        for directory in sorted(directories, key=lambda d: -d.count(os.sep)):
+            while directory != dst and directory.startswith(dst + os.sep):
+                try:
+                    if os.listdir(directory):
+                        break
+                    self.log.info('Remove empty directory: %s' % directory)
+                    os.rmdir(directory)
+                except OSError, (ecode, emsg):
+                    self.log.info('Error removing directory %s: %s' % (directory, emsg))
+                    break
+                directory = os.path.dirname(directory)
 
     def run(self):
         if not os.path.isdir(self.src_tree.path):
@@ -119,57 +320,180 @@ class FilesystemSyncThread(SyncThread):
 
         src = self.src_tree
         dst = self.dst_tree
+        copier = TrackCopyManager(self.copy_threads, preserve_mtime=self.compare=='mtime')
+        manifest = SyncManifest(dst.path)
+        if not self.verify:
+            manifest.load()
+
+        entries = {}
+        expected = set()
+        created_dirs = set()
         i=0
 
+        started = time.time()
         for album in src.as_albums():
-            dst_album_path = os.path.join(dst.path, src.relative_path(album.path))
+            dst_album_path = os.path.join(dst.path, os.path.relpath(album.path, src.path))
             if self.rename is not None:
                 dst_album_path = self.rename(dst_album_path)
 
-            if not os.path.isdir(dst_album_path):
-                try:
-                    self.log.info('Create directory: %s' % dst_album_path)
-                    os.makedirs(dst_album_path)
-
-                except OSError, (ecode, emsg):
-                    self.log.info('Error creating directory %s: %s' % (dst_album_path, emsg))
-                    continue
-
             for track in album:
                 i+=1
-                dst_track_path = os.path.join(dst.path, track.relative_path)
+                relative_path = os.path.relpath(track.path, src.path)
+                dst_track_path = os.path.join(dst.path, relative_path)
 
                 if self.rename:
                     dst_track_path = self.rename(dst_track_path)
-                dst_track = Track(os.path.join(dst_track_path))
 
-                modified = False
-                if not os.path.isfile(dst_track.path):
-                    self.log.info('%6d new: %s' % (i, dst_track.path))
-                    modified = True
+                src_stat = os.stat(track.path)
+                entry = {
+                    'path': os.path.relpath(dst_track_path, dst.path),
+                    'size': src_stat.st_size,
+                    'mtime': src_stat.st_mtime,
+                }
+                entries[relative_path] = entry
+                expected.add(entry['path'])
+
+                if manifest.get(relative_path) == entry:
+                    # Unchanged since last sync, don't touch destination
+                    continue
+
+                try:
+                    dst_stat = os.stat(dst_track_path)
+                except OSError:
+                    dst_stat = None
+
+                if dst_stat is None:
+                    self.log.info('%6d new: %s' % (i, dst_track_path))
+
+                elif self.is_modified(src_stat, track.path, dst_stat, dst_track_path):
+                    self.log.info('%6d modified: %s' % (i, dst_track_path))
+
+                else:
+                    continue
 
-                elif track.size != dst_track.size:
-                    self.log.info('%6d modified: %s' % (i, dst_track.path))
-                    modified = True
+                if self.dry_run:
+                    continue
 
-                if modified:
+                if dst_album_path not in created_dirs and not os.path.isdir(dst_album_path):
                     try:
-                        self.copy_track(track.path, dst_track.path)
+                        self.log.info('Create directory: %s' % dst_album_path)
+                        os.makedirs(dst_album_path)
 
-                    except SyncError, emsg:
-                        print emsg
+                    except OSError, (ecode, emsg):
+                        self.log.info('Error creating directory %s: %s' % (dst_album_path, emsg))
+                        del entries[relative_path]
                         continue
+                created_dirs.add(dst_album_path)
+
+                copier.enqueue((track.path, dst_track_path))
+
+        copier.run()
+        failed = copier.errors
+        for result in failed:
+            self.log.info(result.error)
+            # Retry failed copies on next sync
+            entries.pop(os.path.relpath(result.entry[0], src.path), None)
+
+        if self.delete:
+            self.remove_stale(manifest, expected)
+
+        if not self.dry_run:
+            try:
+                manifest.save(entries)
+            except SyncError, emsg:
+                self.log.info(emsg)
+
+        elapsed = max(time.time() - started, 0.001)
+        self.log.info('Copied %d files, %.1f MB in %.1f seconds: %.1f files/s, %.2f MB/s, %d failed' % (
+            copier.files,
+            copier.bytes / 1048576.0,
+            elapsed,
+            copier.files / elapsed,
+            copier.bytes / 1048576.0 / elapsed,
+            len(failed),
+        ))
+
+        if failed:
+            raise SyncError('Error copying %d files from %s to %s' % (len(failed), src.path, dst.path))
 
 class RsyncThread(SyncThread):
-    def __init__(self, manager, index, src, dst, flags, delete=False):
-        SyncThread.__init__(self, manager, index, src, dst, delete)
+    def __init__(self, manager, index, src, dst, flags, delete=False, dry_run=False, progress=False):
+        SyncThread.__init__(self, manager, index, src, dst, delete, dry_run)
         if isinstance(flags, basestring):
             flags = flags.split()
+        elif flags is None:
+            flags = []
 
-        if delete and not RSYNC_DELETE_FLAGS.intersection(set(flags)):
+        if delete and not set(RSYNC_DELETE_FLAGS).intersection(set(flags)):
             flags.insert(0, DEFAULT_DELETE_FLAG)
 
+        if dry_run and '--dry-run' not in flags:
+            flags.insert(0, '--dry-run')
+
+        if progress:
+            for flag in RSYNC_PROGRESS_FLAGS:
+                if flag not in flags:
+                    flags.append(flag)
+
         self.flags = flags
+        self.progress = {
+            'bytes': 0,
+            'percent': 0,
+            'rate': None,
+            'eta': None,
+            'files': 0,
+            'remaining': None,
+            'total': None,
+        }
+        self.stats = {}
+        self.errors = []
+
+    def parse_output(self, line):
+        """
+        Parse progress and statistics from rsync output line
+        """
+        m = RE_RSYNC_PROGRESS.match(line)
+        if m:
+            for k, v in m.groupdict().items():
+                if v is None:
+                    continue
+                if k in ('bytes', 'percent', 'files', 'remaining', 'total'):
+                    v = int(v.replace(',', ''))
+                self.progress[k] = v
+            self.log.debug('%s %s' % (self.index, line.strip()))
+            return
+
+        m = RE_RSYNC_STATS.match(line)
+        if m:
+            self.stats[m.group('key')] = int(m.group('value').replace(',', ''))
+
+        self.log.info(line.rstrip())
+
+    def read_output(self, p):
+        """
+        Read rsync stdout and stderr at the same time, to never let rsync
+        block writing to a full pipe.
+        """
+        streams = {p.stdout.fileno(): '', p.stderr.fileno(): ''}
+        while streams:
+            ready, _, _ = select.select(streams.keys(), [], [])
+            for fd in ready:
+                data = os.read(fd, 65536)
+                if data == '':
+                    lines = [streams.pop(fd)]
+                else:
+                    # Progress lines are terminated with carriage return
+                    lines = re.split('[\r\n]', streams[fd] + data)
+                    streams[fd] = lines.pop()
+
+                for line in lines:
+                    if line.strip() == '':
+                        continue
+                    if fd == p.stderr.fileno():
+                        self.errors.append(line)
+                        self.log.info('rsync: %s' % line)
+                    else:
+                        self.parse_output(line)
 
     def run(self):
         command = ['rsync', '-av'] + self.flags + ['%s/' % self.src, '%s/' % self.dst]
@@ -178,18 +502,21 @@ class RsyncThread(SyncThread):
         try:
             self.log.info('Running: %s' % ' '.join(command))
 
-            p = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            rval = None
-            while rval is None:
-                while True:
-                    l = p.stdout.readline()
-                    if l == '': break
-                    self.log.info(l.rstrip())
-                time.sleep(0.2)
-                rval = p.poll()
+            devnull = open(os.devnull, 'r')
+            try:
+                p = Popen(command, stdin=devnull, stdout=PIPE, stderr=PIPE, close_fds=True)
+                self.read_output(p)
+                rval = p.wait()
+            except OSError, (ecode, emsg):
+                raise SyncError('Error running rsync: %s' % emsg)
+            finally:
+                devnull.close()
 
             if rval != 0:
-                self.log.info('Error running command %s: %s' % (self, p.stderr.read()))
+                self.log.info('Error running command %s: %s' % (self, '\n'.join(self.errors)))
+                raise SyncError('rsync %s to %s failed with code %d: %s' % (
+                    self.src, self.dst, rval, '\n'.join(self.errors)
+                ))
 
         except KeyboardInterrupt:
             self.log.debug('Rsync interrupted')
@@ -198,10 +525,19 @@ class RsyncThread(SyncThread):
         self.log.info('Finished: %s' % ' '.join(command))
 
 class SyncManager(MusaThreadManager):
-    def __init__(self, threads=None, delete=False, debug=False):
-        MusaThreadManager.__init__(self, 'sync', threads)
+    def __init__(self, threads=None, delete=False, debug=False, executor=None,
+                 compare='size', copy_threads=None, verify=False, dry_run=False, progress=False):
+        MusaThreadManager.__init__(self, 'sync', threads, executor)
         self.delete = delete
+        self.dry_run = dry_run
+        self.progress = progress
+        self.handlers = []
         self.debug = debug
+        self.compare = compare
+        self.copy_threads = copy_threads
+        self.verify = verify
+        # Read here: handlers are created in worker threads
+        self.walker_threads = int(self.db.get('walker_threads') or DEFAULT_WALKER_THREADS)
 
         if not debug:
             self.log = SoundforestLogger('sync').register_file_handler('sync', MUSA_USER_DIR)
@@ -229,10 +565,20 @@ class SyncManager(MusaThreadManager):
     def rename_callbacks(self):
         return RENAME_CALLBACKS
 
+    @property
+    def transferred(self):
+        """
+        Bytes transferred by running and finished rsync targets. Not available
+        with process executor, where handlers run in child processes.
+        """
+        return sum(handler.progress['bytes'] for handler in self.handlers)
+
     def get_entry_handler(self, index, config):
         sync_type = config.pop('type', None)
         if sync_type=='rsync':
-            return RsyncThread(manager=self, index=index, **config)
+            handler = RsyncThread(manager=self, index=index, **config)
+            self.handlers.append(handler)
+            return handler
 
         elif sync_type=='directory':
             if 'flags' in config:
@@ -253,6 +599,21 @@ class SyncManager(MusaThreadManager):
         if 'delete' not in config:
             config['delete'] = self.delete
 
+        if 'dry_run' not in config:
+            config['dry_run'] = self.dry_run
+
+        if sync_type == 'rsync':
+            if 'progress' not in config:
+                config['progress'] = self.progress
+
+        if sync_type == 'directory':
+            if 'compare' not in config:
+                config['compare'] = self.compare
+            if 'copy_threads' not in config:
+                config['copy_threads'] = self.copy_threads
+            if 'verify' not in config:
+                config['verify'] = self.verify
+
         for k in ('id', 'name', 'defaults'):
             if k in config:
                 config.pop(k)
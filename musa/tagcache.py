@@ -0,0 +1,234 @@
+# coding=utf-8
+"""Tag cache
+
+Persistent cache of parsed track tags, keyed by real file path, size and mtime
+
+"""
+
+import os
+import json
+import atexit
+import sqlite3
+import threading
+
+from datetime import datetime
+
+from musa.defaults import MUSA_CACHE_DIR
+from soundforest.tags.constants import STANDARD_TAG_MAP
+from soundforest.tags.xmltag import XMLTags
+
+TAG_CACHE_DB = os.path.join(MUSA_CACHE_DIR, 'tags.sqlite')
+
+# Number of stored entries to commit at once
+COMMIT_INTERVAL = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tags (
+    path        TEXT PRIMARY KEY,
+    size        INTEGER NOT NULL,
+    mtime       REAL NOT NULL,
+    tags        TEXT NOT NULL
+);
+"""
+
+
+class TagCacheError(Exception):
+    pass
+
+
+class CachedTags(dict):
+    """
+    Read only track tags loaded from tag cache.
+
+    Provides the tag listing methods of soundforest tag parsers: tags can't
+    be modified or saved.
+    """
+    def __init__(self, path, size, mtime, items):
+        dict.__init__(self, items)
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.tag_order = [tag for tag, values in items]
+
+    def keys(self):
+        return list(self.tag_order)
+
+    def items(self):
+        return [(tag, self[tag]) for tag in self.tag_order]
+
+    def get_tag(self, tag):
+        return self[tag]
+
+    def as_dict(self):
+        return dict(self.items())
+
+    def as_xml(self):
+        return XMLTags(self.as_dict())
+
+    def to_json(self, indent=2):
+        return json.dumps(
+            {
+                'filename': self.path,
+                'modified': datetime.fromtimestamp(self.mtime).isoformat(),
+                'size': self.size,
+                'tags': [
+                    {'tag': k, 'name': k in STANDARD_TAG_MAP and STANDARD_TAG_MAP[k]['label'] or k, 'values': v}
+                    for k, v in self.items()
+                ]
+            },
+            ensure_ascii=False,
+            indent=indent,
+            sort_keys=True
+        )
+
+
+def tag_values(value):
+    """
+    Return tag value as list of unicode strings, for comparing values
+    parsed from files and loaded from cache
+    """
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    return [isinstance(v, unicode) and v or unicode(v) for v in value]
+
+
+def tag_updates(src_tags, dst_tags, ignored=()):
+    """
+    Return list of (tag, old value, new value) tuples for tags in src_tags
+    with different value in dst_tags. Old value is None for tags missing
+    from dst_tags.
+    """
+    # Parsed from items(): get_tag() of soundforest parsers does not find
+    # tags mapped from format specific fields, like ID3 frames
+    target_tags = dict(dst_tags.items())
+
+    updates = []
+    for tag, value in src_tags.items():
+        if tag in ignored:
+            continue
+
+        target_value = target_tags.get(tag, None)
+        if target_value is not None and tag_values(target_value) == tag_values(value):
+            continue
+
+        updates.append((tag, target_value, value))
+
+    return updates
+
+
+class TagCache(object):
+    """
+    Cache of track tags in MUSA_CACHE_DIR.
+
+    Entries are valid while file size and mtime match the cached values.
+    Stored and removed entries are committed in batches and when the process
+    exits.
+    """
+    def __init__(self, path=TAG_CACHE_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.__connection = None
+        self.__pid = None
+
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, (ecode, emsg):
+                if not os.path.isdir(directory):
+                    raise TagCacheError('Error creating directory %s: %s' % (directory, emsg))
+
+        atexit.register(self.flush)
+
+    @property
+    def connection(self):
+        """
+        Database connection, opened separately in each forked process
+        """
+        if self.__connection is None or self.__pid != os.getpid():
+            try:
+                self.__connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+                self.__connection.executescript(SCHEMA)
+            except sqlite3.Error, emsg:
+                raise TagCacheError('Error opening tag cache %s: %s' % (self.path, emsg))
+            self.__pid = os.getpid()
+            self.pending = 0
+        return self.__connection
+
+    def get(self, path):
+        """
+        Return CachedTags for path, or None if path is not cached or was
+        modified after caching
+        """
+        key = os.path.realpath(path)
+        try:
+            st = os.stat(key)
+        except OSError:
+            return None
+
+        with self.lock:
+            try:
+                c = self.connection.cursor()
+                c.execute('SELECT size, mtime, tags FROM tags WHERE path=?', (key, ))
+                entry = c.fetchone()
+            except sqlite3.Error, emsg:
+                raise TagCacheError('Error reading tag cache: %s' % emsg)
+
+        if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime:
+            return None
+
+        return CachedTags(path, entry[0], entry[1], json.loads(entry[2]))
+
+    def store(self, path, tags):
+        """
+        Store tags parsed from file to cache
+        """
+        key = os.path.realpath(path)
+        try:
+            st = os.stat(key)
+        except OSError:
+            return
+
+        data = json.dumps([(tag, values) for tag, values in tags.items()])
+        with self.lock:
+            try:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO tags (path, size, mtime, tags) VALUES (?, ?, ?, ?)',
+                    (key, st.st_size, st.st_mtime, data)
+                )
+                self.pending += 1
+                if self.pending >= COMMIT_INTERVAL:
+                    self.connection.commit()
+                    self.pending = 0
+            except sqlite3.Error, emsg:
+                raise TagCacheError('Error updating tag cache: %s' % emsg)
+
+    def invalidate(self, path):
+        """
+        Remove cached tags for path. Removals are committed in batches like
+        stored entries.
+        """
+        key = os.path.realpath(path)
+        with self.lock:
+            try:
+                self.connection.execute('DELETE FROM tags WHERE path=?', (key, ))
+                self.pending += 1
+                if self.pending >= COMMIT_INTERVAL:
+                    self.connection.commit()
+                    self.pending = 0
+            except sqlite3.Error, emsg:
+                raise TagCacheError('Error updating tag cache: %s' % emsg)
+
+    def flush(self):
+        """
+        Commit stored entries
+        """
+        if self.__connection is None or self.__pid != os.getpid():
+            return
+        with self.lock:
+            try:
+                self.connection.commit()
+                self.pending = 0
+            except sqlite3.Error:
+                pass
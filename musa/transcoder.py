@@ -11,12 +11,36 @@ import shutil
 import time
 import tempfile
 
-from musa.defaults import MUSA_CACHE_DIR
+from subprocess import Popen, PIPE
+
+from musa.defaults import MUSA_CACHE_DIR, TARGET_FILE_MODE
+from musa.cache import CacheError
 from musa.cli import ScriptThread, MusaThreadManager
 from soundforest.tags import TagError
 from soundforest.tree import Tree, Album, Track, TreeError
 
 
+# Decoder and encoder commands known to write to stdout and read from stdin
+# when given '-' as OUTFILE / FILE argument. Other commands require seekable
+# temporary files.
+STREAMING_DECODERS = (
+    'flac',
+    'lame',
+    'oggdec',
+    'wvunpack',
+)
+STREAMING_ENCODERS = (
+    'flac',
+    'lame',
+    'neroAacEnc',
+    'oggenc',
+)
+# Encoder options requiring seekable input, disabling streaming
+NON_STREAMING_OPTIONS = (
+    '-2pass',
+)
+STREAM_PATH = '-'
+
 class TranscoderError(Exception):
     """Exceptions raised by transcoder threads"""
 
@@ -24,18 +48,57 @@ class TranscoderError(Exception):
         return self.args[0]
 
 
+def target_status(src, dst, overwrite=False, incremental=False, sources=None):
+    """
+    Return 'new' or 'refreshed' if dst path must be transcoded from src path,
+    or None if existing target is up to date.
+
+    Empty targets left by interrupted runs are always refreshed. In
+    incremental mode target is refreshed if source was modified after target
+    was written. Sources copied back with their original, older modification
+    time are detected from source size and mtime recorded to sources, if
+    given, when target was written.
+    """
+    try:
+        dst_stat = os.stat(dst)
+    except OSError:
+        return 'new'
+
+    if overwrite or dst_stat.st_size == 0:
+        return 'refreshed'
+
+    if incremental:
+        src_stat = os.stat(src)
+        if src_stat.st_mtime > dst_stat.st_mtime:
+            return 'refreshed'
+
+        if sources is not None:
+            try:
+                recorded = sources.get(dst)
+            except CacheError:
+                recorded = None
+            if recorded is not None and tuple(recorded) != (src_stat.st_size, src_stat.st_mtime):
+                return 'refreshed'
+
+    return None
+
+
 class TranscoderThread(ScriptThread):
     """
     Class to transcode one file from Transcoder queue.
     """
 
-    def __init__(self, index, src, dst, overwrite=False, dry_run=False):
+    def __init__(self, index, src, dst, overwrite=False, dry_run=False, streaming=True, cache=None,
+                 sources=None):
         ScriptThread.__init__(self, 'convert')
         self.index = index
         self.src = src
         self.dst = dst
         self.overwrite = overwrite
         self.dry_run = dry_run
+        self.streaming = streaming
+        self.cache = cache
+        self.sources = sources
 
         if not os.path.isdir(MUSA_CACHE_DIR):
             try:
@@ -47,10 +110,141 @@ class TranscoderThread(ScriptThread):
         print message
         sys.exit(1)
 
+    def supports_streaming(self, decoder, encoder):
+        """
+        Check if decoder output can be piped directly to encoder input
+        """
+        if not self.streaming:
+            return False
+        if os.path.basename(decoder[0]) not in STREAMING_DECODERS:
+            return False
+        if os.path.basename(encoder[0]) not in STREAMING_ENCODERS:
+            return False
+        if [option for option in encoder[1:] if option in NON_STREAMING_OPTIONS]:
+            return False
+        return True
+
+    def pipe(self, decoder, encoder):
+        """
+        Run decoder and encoder connected with a pipe, without writing
+        intermediate wav file to disk.
+        """
+        devnull = open(os.devnull, 'r')
+        try:
+            try:
+                dec = Popen(decoder, stdin=devnull, stdout=PIPE, stderr=sys.stderr)
+            except OSError, (ecode, emsg):
+                raise TranscoderError('Error running %s: %s' % (' '.join(decoder), emsg))
+
+            try:
+                enc = Popen(encoder, stdin=dec.stdout, stdout=sys.stdout, stderr=sys.stderr)
+            except OSError, (ecode, emsg):
+                # Decoder would block writing to the pipe nobody reads
+                dec.stdout.close()
+                dec.kill()
+                dec.wait()
+                raise TranscoderError('Error running %s: %s' % (' '.join(encoder), emsg))
+
+            # Allow decoder to receive SIGPIPE if encoder exits early
+            dec.stdout.close()
+            enc_rval = enc.wait()
+            dec_rval = dec.wait()
+        finally:
+            devnull.close()
+
+        if dec_rval != 0:
+            raise TranscoderError('Error decoding %s: returns %s' % (self.src.path, dec_rval))
+        if enc_rval != 0:
+            raise TranscoderError('Error encoding %s: returns %s' % (self.dst.path, enc_rval))
+
+    def transcode_streaming(self):
+        """
+        Transcode by piping decoder output to encoder. The target is encoded
+        to a temporary file in the destination directory and renamed in place.
+        """
+        try:
+            decoder = self.src.get_decoder_command(STREAM_PATH)
+            if self.dry_run:
+                encoder = self.dst.get_encoder_command(STREAM_PATH)
+        except TreeError, emsg:
+            self.error(emsg)
+
+        if self.dry_run:
+            self.log.debug('pipe: %s | %s' % (' '.join(decoder), ' '.join(encoder)))
+            self.log.debug('target file: %s' % self.dst.path)
+            return
+
+        # Hidden name is ignored by watch. Encoders overwrite the file, which
+        # is created with mkstemp permissions: reset these to umask defaults.
+        try:
+            fd, dst_tmp = tempfile.mkstemp(
+                dir=os.path.dirname(self.dst.path), prefix='.musa-', suffix='.%s' % self.dst.extension
+            )
+            os.close(fd)
+        except OSError, (ecode, emsg):
+            raise TranscoderError('Error creating temporary file for %s: %s' % (self.dst.path, emsg))
+
+        try:
+            os.chmod(dst_tmp, TARGET_FILE_MODE)
+            try:
+                encoder = Track(dst_tmp).get_encoder_command(STREAM_PATH)
+            except TreeError, emsg:
+                self.error(emsg)
+
+            self.status = 'transcoding'
+            self.log.debug('transcoding: %s %s' % (self.index, self.src.path))
+            self.pipe(decoder, encoder)
+            os.rename(dst_tmp, self.dst.path)
+
+        except OSError, (ecode, emsg):
+            raise TranscoderError('Error writing %s: %s' % (self.dst.path, emsg))
+
+        finally:
+            if os.path.isfile(dst_tmp):
+                try:
+                    os.unlink(dst_tmp)
+                except OSError:
+                    pass
+
+    def transcode_wav(self):
+        """
+        Transcode by decoding to a temporary wav file and encoding it to
+        target file. Used when codec commands require seekable files.
+        """
+        wav = tempfile.NamedTemporaryFile(
+            dir=MUSA_CACHE_DIR, prefix='musa-', suffix='.wav'
+        )
+        dst_tmp = tempfile.NamedTemporaryFile(
+            dir=MUSA_CACHE_DIR, prefix='musa-', suffix='.%s' % self.dst.extension
+        )
+        dst = Track(dst_tmp.name)
+
+        try:
+            decoder = self.src.get_decoder_command(wav.name)
+            encoder = dst.get_encoder_command(wav.name)
+        except TreeError, emsg:
+            self.error(emsg)
+
+        if self.dry_run:
+            self.log.debug('decoder: %s' % ' '.join(decoder))
+            self.log.debug('encoder: %s' % ' '.join(encoder))
+            self.log.debug('target file: %s' % self.dst.path)
+            return
+
+        self.status = 'transcoding'
+        self.log.debug('decoding: %s %s' % (self.index, self.src.path))
+        if self.execute(decoder) != 0:
+            raise TranscoderError('Error decoding %s' % self.src.path)
+        self.log.debug('encoding: %s %s' % (self.index, self.dst.path))
+        if self.execute(encoder) != 0:
+            raise TranscoderError('Error encoding %s' % self.dst.path)
+        shutil.copyfile(dst.path, self.dst.path)
+
     def run(self):
         """
-        Run the thread, calling source_song.decode() to create a temporary
-        wav file and dst_song.encode() to encode this wav file to target file.
+        Run the thread, piping decoder output of source song to the encoder
+        of target song when codecs support it, or decoding to a temporary wav
+        file and encoding this wav file to target file.
         """
         self.status = 'initializing'
 
@@ -75,49 +269,36 @@ class TranscoderThread(ScriptThread):
                 else:
                     self.error('Error creating directory %s: %s' % (dst_dir, emsg))
 
-        wav = tempfile.NamedTemporaryFile(
-            dir=MUSA_CACHE_DIR, prefix='musa-', suffix='.wav'
-        )
-        src_tmp = tempfile.NamedTemporaryFile(
-            dir=MUSA_CACHE_DIR, prefix='musa-', suffix='.%s' % self.src.extension
-        )
-        src = Track(src_tmp.name)
-        dst_tmp = tempfile.NamedTemporaryFile(
-            dir=MUSA_CACHE_DIR, prefix='musa-', suffix='.%s' % self.dst.extension
-        )
-        src = Track(src_tmp.name)
-        dst = Track(dst_tmp.name)
-        if not self.dry_run:
-            open(src.path, 'wb').write(open(self.src.path, 'rb').read())
-
         try:
-            decoder = src.get_decoder_command(wav.name)
-            encoder = dst.get_encoder_command(wav.name)
+            decoder = self.src.get_decoder_command(STREAM_PATH)
+            encoder = self.dst.get_encoder_command(STREAM_PATH)
         except TreeError, emsg:
             self.error(emsg)
 
+        cache_key = None
+        cached = False
+        if self.cache is not None and not self.dry_run:
+            try:
+                cache_key = self.cache.key(
+                    self.src.path, '%s %s' % (self.dst.extension, self.dst.get_available_encoders()[0])
+                )
+                if self.cache.fetch(cache_key, self.dst.path):
+                    self.log.debug('cached: %s %s' % (self.index, self.dst.path))
+                    cached = True
+            except CacheError, emsg:
+                self.log.debug('Error using transcode cache: %s' % emsg)
+                cache_key = None
 
         try:
-            if not self.dry_run:
-                self.status = 'transcoding'
-                self.log.debug('decoding: %s %s' % (self.index, self.src.path))
-                self.execute(decoder)
-                self.log.debug('encoding: %s %s' % (self.index, self.dst.path))
-                self.execute(encoder)
-                shutil.copyfile(dst.path, self.dst.path)
+            if cached:
+                pass
+            elif self.supports_streaming(decoder, encoder) and os.path.isdir(dst_dir):
+                self.transcode_streaming()
             else:
-                self.log.debug('decoder: %s' % ' '.join(decoder))
-                self.log.debug('encoder: %s' % ' '.join(encoder))
-                self.log.debug('target file: %s' % self.dst.path)
-            del(wav)
+                self.transcode_wav()
 
         except TranscoderError, emsg:
-            if wav and os.path.isfile(wav):
-                try:
-                    del(wav)
-                except OSError:
-                    pass
-            self.status = str(e)
+            self.status = str(emsg)
             self.error('ERROR transcoding: %s' % emsg)
 
         if not self.dry_run and not os.path.isfile(self.dst.path):
@@ -138,14 +319,30 @@ class TranscoderThread(ScriptThread):
             except TagError, emsg:
                 self.error(emsg)
 
+        if cache_key is not None and not cached:
+            try:
+                self.cache.store(cache_key, self.dst.path)
+            except CacheError, emsg:
+                self.log.debug('Error storing %s to transcode cache: %s' % (self.dst.path, emsg))
+
+        if self.sources is not None and not self.dry_run:
+            try:
+                self.sources.store(self.dst.path, self.src.path)
+            except CacheError, emsg:
+                self.log.debug('Error recording source of %s: %s' % (self.dst.path, emsg))
+
         self.status = 'finished'
 
 
 class MusaTranscoder(MusaThreadManager):
-    def __init__(self, threads, overwrite=False, dry_run=False):
-        MusaThreadManager.__init__(self, 'convert', int(threads))
+    def __init__(self, threads, overwrite=False, dry_run=False, streaming=True, executor=None, cache=None,
+                 sources=None):
+        MusaThreadManager.__init__(self, 'convert', threads, executor)
         self.overwrite = overwrite
         self.dry_run = dry_run
+        self.streaming = streaming
+        self.cache = cache
+        self.sources = sources
 
     def enqueue(self, src, dst):
         if not isinstance(src, Track) or not isinstance(dst, Track):
@@ -169,9 +366,15 @@ class MusaTranscoder(MusaThreadManager):
 
     def get_entry_handler(self, index, entry):
         src, dst = entry
-        return TranscoderThread(index, src, dst, self.overwrite, self.dry_run)
+        return TranscoderThread(
+            index, src, dst, self.overwrite, self.dry_run, self.streaming, self.cache, self.sources
+        )
 
     def run(self):
-        self.log.debug('Transcoding %s files with %d threads' % (len(self), self.threads))
-        MusaThreadManager.run(self)
+        self.log.debug('Transcoding %s files with %d %s' % (len(self), self.threads, self.executor))
+        results = MusaThreadManager.run(self)
+        errors = self.errors
+        if errors:
+            self.log.info('%d of %d files failed to transcode' % (len(errors), len(results)))
+        return results
 
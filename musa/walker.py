@@ -0,0 +1,282 @@
+# coding=utf-8
+"""Directory walker
+
+Lazy directory tree walking for track and album discovery, optionally
+listing directories in parallel
+
+"""
+
+import os
+import sys
+import threading
+import Queue
+
+from soundforest.formats import match_codec, match_metadata
+from soundforest.tree import IterableTrackFolder, Tree, Album, Track, MetaDataFile, TreeError
+
+try:
+    # Backport of os.scandir, avoids stat calls for directory entry types
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+# Default number of directory listing threads
+DEFAULT_WALKER_THREADS = 1
+
+
+def list_directory(path):
+    """
+    Return sorted lists of (directories, files) in path. Symbolic links to
+    directories are listed as directories.
+    """
+    directories = []
+    files = []
+
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir():
+                directories.append(entry.name)
+            else:
+                files.append(entry.name)
+
+    else:
+        for name in os.listdir(path):
+            if os.path.isdir(os.path.join(path, name)):
+                directories.append(name)
+            else:
+                files.append(name)
+
+    return sorted(directories), sorted(files)
+
+
+class TreeWalker(object):
+    """
+    Walks directory tree top down in sorted order, listing each directory
+    only when the walk reaches it. Like os.walk, symbolic links to
+    directories are not followed and unreadable directories are skipped.
+
+    With threads > 1, the next directories in walk order are listed ahead
+    by a pool of worker threads, at most window directories at a time.
+    Results are still returned in the same order as with one thread.
+    """
+    def __init__(self, path, threads=DEFAULT_WALKER_THREADS, window=None):
+        self.path = path
+        self.threads = max(int(threads or 1), 1)
+        if window is None:
+            window = self.threads * 4
+        self.window = max(int(window), 1)
+
+    def list(self, root):
+        """
+        Return (directories, files, subdirectories to walk) for root, or
+        None if root can't be listed
+        """
+        try:
+            directories, files = list_directory(root)
+        except OSError:
+            return None
+
+        children = []
+        for name in directories:
+            path = os.path.join(root, name)
+            if not os.path.islink(path):
+                children.append(path)
+        return directories, files, children
+
+    def walk(self):
+        """
+        Yield (root, directories, files) tuples
+        """
+        if self.threads > 1:
+            for entry in self.walk_parallel():
+                yield entry
+            return
+
+        pending = [self.path]
+        while pending:
+            root = pending.pop()
+            listing = self.list(root)
+            if listing is None:
+                continue
+
+            directories, files, children = listing
+            yield root, directories, files
+            pending.extend(reversed(children))
+
+    def walk_parallel(self):
+        """
+        Walk with directories listed in worker threads. At most window
+        directories are queued or listed ahead of the walk at the same
+        time. Errors from listing a directory are raised when the walk
+        reaches it.
+        """
+        queue = Queue.Queue()
+        listings = {}
+        errors = {}
+        finished = threading.Condition()
+
+        def worker():
+            while True:
+                root = queue.get()
+                if root is None:
+                    break
+                try:
+                    listing = self.list(root)
+                except Exception:
+                    # Raised again in the walking thread
+                    with finished:
+                        errors[root] = sys.exc_info()
+                        listings[root] = None
+                        finished.notify_all()
+                    continue
+                with finished:
+                    listings[root] = listing
+                    finished.notify_all()
+
+        workers = [threading.Thread(target=worker) for i in range(self.threads)]
+        for t in workers:
+            t.setDaemon(True)
+            t.start()
+
+        queued = set()
+
+        def queue_ahead(pending):
+            # Next directories in walk order are at the end of pending
+            for path in reversed(pending):
+                if len(queued) >= self.window:
+                    break
+                if path not in queued:
+                    queue.put(path)
+                    queued.add(path)
+
+        try:
+            pending = [self.path]
+            while pending:
+                queue_ahead(pending)
+                root = pending.pop()
+                if root not in queued:
+                    # Window is full with directories deeper in the walk
+                    queue.put(root)
+                    queued.add(root)
+
+                with finished:
+                    while root not in listings:
+                        # Timeout keeps main thread responsive to signals
+                        finished.wait(1)
+                    listing = listings.pop(root)
+                    error = errors.pop(root, None)
+                queued.discard(root)
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                if listing is None:
+                    continue
+
+                directories, files, children = listing
+                yield root, directories, files
+                pending.extend(reversed(children))
+
+        finally:
+            for t in workers:
+                queue.put(None)
+            for t in workers:
+                t.join()
+
+    def album_listings(self):
+        """
+        Yield (directory, files) for directories with audio files. All files
+        in the directory are returned.
+        """
+        for root, directories, files in self.walk():
+            for f in files:
+                if match_codec(f) is not None:
+                    yield root, files
+                    break
+
+    def albums(self):
+        """
+        Yield (directory, filenames) for directories with audio files
+        """
+        for root, files in self.album_listings():
+            yield root, [f for f in files if match_codec(f) is not None]
+
+    def tracks(self):
+        """
+        Yield tracks as they are found
+        """
+        for root, filenames in self.albums():
+            for filename in filenames:
+                try:
+                    yield Track(os.path.join(root, filename))
+                except TreeError:
+                    continue
+
+    def has_tracks(self):
+        """
+        Check if tree contains audio files, stopping at first match
+        """
+        for root, filenames in self.albums():
+            return True
+        return False
+
+
+def listed_album(path, files):
+    """
+    Return Album for path with tracks and metadata files from directory
+    listing, without listing the directory again
+    """
+    album = Album(path)
+    for f in files:
+        if match_codec(f) is not None:
+            album.files.append((album.path, f))
+        else:
+            metadata = match_metadata(f)
+            if metadata is not None:
+                album.metadata_files.append(MetaDataFile(os.path.join(album.path, f), metadata))
+    album.files.sort()
+    album.has_been_iterated = True
+    return album
+
+
+class MusaTree(Tree):
+    """
+    Tree iterated lazily while directories are walked, instead of loading
+    the whole tree before returning first track.
+
+    Directories are walked with given number of listing threads. Other
+    Tree attributes load the tree with the same walker when accessed.
+    """
+    def __init__(self, path, threads=DEFAULT_WALKER_THREADS):
+        Tree.__init__(self, path)
+        self.walker = TreeWalker(self.path, threads)
+
+    def __iter__(self):
+        return self.walker.tracks()
+
+    def has_tracks(self):
+        return self.walker.has_tracks()
+
+    def load(self):
+        """
+        Load the albums and songs in the tree
+        """
+        if not os.path.isdir(self.path):
+            raise TreeError('Not a directory: %s' % self.path)
+
+        IterableTrackFolder.load(self)
+        self.paths = {}
+        self.empty_dirs = []
+        for root, directories, files in self.walker.walk():
+            if files:
+                self.files.extend((root, x) for x in files)
+                for x in files:
+                    self.paths[os.path.join(root, x)] = True
+            elif not directories:
+                self.empty_dirs.append(root)
+
+        self.relative_dirs = set(self.relative_path(x[0]) for x in self.files)
+
+    def as_albums(self):
+        """
+        Return albums in walk order
+        """
+        return [listed_album(root, files) for root, files in self.walker.album_listings()]
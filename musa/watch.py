@@ -0,0 +1,182 @@
+# coding=utf-8
+"""Library watcher
+
+Watch music trees for modified directories with inotify, or by polling file
+sizes and mtimes when pyinotify is not available
+
+"""
+
+import os
+import time
+
+from soundforest import normalized
+from soundforest.formats import match_codec
+from soundforest.log import SoundforestLogger
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# Seconds without new changes before a batch of changes is processed
+DEFAULT_DEBOUNCE = 2
+# Maximum seconds to delay processing while changes keep arriving
+DEFAULT_MAX_DELAY = 60
+# Seconds between filesystem scans with polling watcher
+DEFAULT_POLL_INTERVAL = 30
+
+
+class WatchError(Exception):
+    pass
+
+
+def is_watched_file(filename):
+    """
+    Check if changes to filename are of interest. Hidden files, including
+    musa temporary files, are ignored.
+    """
+    return not filename.startswith('.') and match_codec(filename) is not None
+
+
+class PollingWatcher(object):
+    """
+    Detect modified directories by comparing sizes and mtimes of audio files
+    between scans of the trees.
+    """
+    def __init__(self, paths, interval=DEFAULT_POLL_INTERVAL):
+        self.paths = paths
+        self.interval = interval
+        self.state = self.scan()
+        self.scanned = time.time()
+
+    def scan(self):
+        """
+        Return dictionary of directories and their audio file stat details
+        """
+        state = {}
+        for path in self.paths:
+            for root, dirs, files in os.walk(path):
+                entries = {}
+                for filename in files:
+                    if not is_watched_file(filename):
+                        continue
+                    try:
+                        st = os.stat(os.path.join(root, filename))
+                    except OSError:
+                        continue
+                    entries[filename] = (st.st_size, st.st_mtime)
+                state[normalized(root)] = entries
+        return state
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds and return set of modified directories
+        """
+        delay = self.scanned + self.interval - time.time()
+        if delay > 0:
+            time.sleep(min(delay, timeout))
+            return set()
+
+        state = self.scan()
+        self.scanned = time.time()
+
+        changed = set()
+        for directory in set(self.state.keys()) | set(state.keys()):
+            if self.state.get(directory) != state.get(directory):
+                changed.add(directory)
+        self.state = state
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Detect modified directories with inotify events. New directories are
+    added to watches automatically.
+    """
+    def __init__(self, paths):
+        if pyinotify is None:
+            raise WatchError('pyinotify module is not available')
+
+        self.changed = set()
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, self.process_event)
+
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+               pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+        for path in paths:
+            self.manager.add_watch(path, mask, rec=True, auto_add=True)
+
+    def process_event(self, event):
+        if event.dir:
+            self.changed.add(normalized(event.path))
+            self.changed.add(normalized(event.pathname))
+        elif is_watched_file(event.name):
+            self.changed.add(normalized(event.path))
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds and return set of modified directories
+        """
+        if self.notifier.check_events(int(timeout*1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+        changed = self.changed
+        self.changed = set()
+        return changed
+
+    def close(self):
+        self.notifier.stop()
+
+
+class LibraryWatcher(object):
+    """
+    Watch paths for changes, collecting bursts of changes to batches.
+
+    A batch is ready when no new changes have been seen in debounce seconds,
+    or when changes have been pending for max_delay seconds.
+    """
+    def __init__(self, paths, debounce=DEFAULT_DEBOUNCE, max_delay=DEFAULT_MAX_DELAY,
+                 polling=False, interval=DEFAULT_POLL_INTERVAL):
+        self.log = SoundforestLogger().default_stream
+        self.paths = [normalized(path) for path in paths]
+        self.debounce = debounce
+        self.max_delay = max_delay
+
+        if not polling and pyinotify is not None:
+            self.watcher = InotifyWatcher(self.paths)
+            self.mode = 'inotify'
+        else:
+            self.watcher = PollingWatcher(self.paths, interval)
+            self.mode = 'polling'
+
+    def batches(self):
+        """
+        Yield sets of modified directories until interrupted
+        """
+        pending = set()
+        first = last = None
+        try:
+            while True:
+                changed = self.watcher.wait(1)
+                now = time.time()
+
+                if changed:
+                    self.log.debug('Modified: %s' % ' '.join(sorted(changed)))
+                    if not pending:
+                        first = now
+                    pending.update(changed)
+                    last = now
+
+                if not pending:
+                    continue
+
+                if now - last >= self.debounce or now - first >= self.max_delay:
+                    yield pending
+                    pending = set()
+
+        finally:
+            self.watcher.close()
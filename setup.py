@@ -21,5 +21,11 @@ setup(
         'configobj', 
         'soundforest>=3.4.4', 
     ),
+    extras_require = {
+        # Faster directory listing, os.listdir is used without it
+        'scandir': ( 'scandir', ),
+        # Change notifications for musa watch, trees are polled without it
+        'inotify': ( 'pyinotify', ),
+    },
 )
 
@@ -2,7 +2,20 @@
 Unit tests for musa library
 """
 
+from test_albumart import *
+from test_cache import *
+from test_cleanup import *
+from test_cli import *
 from test_codecs import *
+from test_commands import *
+from test_database import *
 from test_metadata import *
+from test_rename import *
+from test_search import *
+from test_sync import *
+from test_tagcache import *
+from test_transcoder import *
 from test_tree import *
+from test_walker import *
+from test_watch import *
 
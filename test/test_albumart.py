@@ -0,0 +1,75 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from soundforest.tags.albumart import AlbumArtError
+from soundforest.tree import Album
+from musa.albumart import PreparedAlbumArt, album_cover_path
+
+
+class prepared_album_art(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='musa-test-')
+        self.path = os.path.join(self.root, 'artwork.jpg')
+        Image.new('RGB', (400, 200), (200, 100, 50)).save(self.path, 'JPEG')
+        self.data = open(self.path, 'rb').read()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_original(self):
+        # Images within max_size keep original bytes
+        for max_size in (None, 400):
+            albumart = PreparedAlbumArt(self.path, max_size)
+            self.assertEquals(albumart.get_fileformat(), 'JPEG')
+            self.assertEquals(albumart.dump(), self.data)
+            self.assertEquals(len(albumart), len(self.data))
+
+    def test_resize(self):
+        albumart = PreparedAlbumArt(self.path, max_size=100)
+        self.assertNotEquals(albumart.dump(), self.data)
+        path = os.path.join(self.root, 'resized.jpg')
+        albumart.save(path)
+        image = Image.open(path)
+        self.assertEquals(image.format, 'JPEG')
+        self.assertEquals(image.size, (100, 50))
+
+    def test_reuse(self):
+        albumart = PreparedAlbumArt(self.path, max_size=100)
+        data = albumart.dump()
+
+        # Prepared bytes are written for each track without encoding again
+        save = Image.Image.save
+        def failing_save(*args, **kwargs):
+            raise AssertionError('Image encoded again')
+        Image.Image.save = failing_save
+        try:
+            for name in ('first', 'second'):
+                self.assertTrue(albumart.dump() is data)
+                path = os.path.join(self.root, name)
+                os.makedirs(path)
+                albumart.save(path)
+                self.assertEquals(open(os.path.join(path, 'artwork.jpg'), 'rb').read(), data)
+        finally:
+            Image.Image.save = save
+
+    def test_invalid_image(self):
+        path = os.path.join(self.root, 'invalid.jpg')
+        open(path, 'wb').write('not an image\n')
+        self.assertRaises(AlbumArtError, PreparedAlbumArt, path)
+        self.assertRaises(AlbumArtError, PreparedAlbumArt, os.path.join(self.root, 'missing.jpg'))
+        self.assertRaises(AlbumArtError, PreparedAlbumArt().dump)
+
+    def test_album_cover_path(self):
+        album = Album(self.root)
+        self.assertEquals(album_cover_path(album), self.path)
+        os.unlink(self.path)
+        self.assertEquals(album_cover_path(Album(self.root)), None)
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(prepared_album_art)
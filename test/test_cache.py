@@ -0,0 +1,84 @@
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from musa.cache import TranscodeCache, TranscodeSources, CacheError
+from musa.defaults import TARGET_FILE_MODE
+
+
+class transcode_cache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='musa-test-')
+        self.cache = TranscodeCache(
+            path=os.path.join(self.root, 'cache'),
+            db_path=os.path.join(self.root, 'cache.sqlite'),
+        )
+        self.sources = []
+        for i in range(3):
+            path = os.path.join(self.root, 'track%d.mp3' % i)
+            open(path, 'w').write('%d' % i * 100)
+            self.sources.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_key_encoder(self):
+        src = self.sources[0]
+        self.assertEquals(self.cache.key(src, 'lame -b 192'), self.cache.key(src, 'lame -b 192'))
+        self.assertNotEquals(self.cache.key(src, 'lame -b 192'), self.cache.key(src, 'lame -b 320'))
+        self.assertEquals(self.cache.key(src, u'lame -b 192'), self.cache.key(src, 'lame -b 192'))
+
+    def test_key_source(self):
+        src = self.sources[0]
+        key = self.cache.key(src, 'lame')
+        open(src, 'a').write('changed')
+        self.assertNotEquals(key, self.cache.key(src, 'lame'))
+        self.assertRaises(CacheError, self.cache.key, os.path.join(self.root, 'missing.mp3'), 'lame')
+
+    def test_key_hash_content(self):
+        self.cache.hash_content = True
+        copy = os.path.join(self.root, 'copy.mp3')
+        shutil.copyfile(self.sources[0], copy)
+        self.assertEquals(self.cache.key(self.sources[0], 'lame'), self.cache.key(copy, 'lame'))
+        self.assertNotEquals(self.cache.key(self.sources[0], 'lame'), self.cache.key(self.sources[1], 'lame'))
+
+    def test_store_fetch(self):
+        key = self.cache.key(self.sources[0], 'lame')
+        dst = os.path.join(self.root, 'output.mp3')
+        self.assertFalse(self.cache.fetch(key, dst))
+        self.cache.store(key, self.sources[0])
+        self.assertTrue(self.cache.fetch(key, dst))
+        self.assertEquals(open(dst).read(), open(self.sources[0]).read())
+        # Fetched files get the same permissions as encoded files
+        self.assertEquals(stat.S_IMODE(os.stat(dst).st_mode), TARGET_FILE_MODE)
+
+    def test_lru_eviction(self):
+        keys = [self.cache.key(src, 'lame') for src in self.sources]
+        # Room for two of the 100 byte files
+        self.cache.max_size = 250
+        self.cache.store(keys[0], self.sources[0])
+        self.cache.store(keys[1], self.sources[1])
+        dst = os.path.join(self.root, 'output.mp3')
+        self.assertTrue(self.cache.fetch(keys[0], dst))
+
+        self.cache.store(keys[2], self.sources[2])
+        self.assertTrue(self.cache.fetch(keys[0], dst))
+        self.assertFalse(self.cache.fetch(keys[1], dst))
+        self.assertTrue(self.cache.fetch(keys[2], dst))
+        self.assertEquals(len(os.listdir(self.cache.path)), 2)
+
+    def test_sources(self):
+        sources = TranscodeSources(os.path.join(self.root, 'sources.sqlite'))
+        dst = os.path.join(self.root, 'output.mp3')
+        self.assertEquals(sources.get(dst), None)
+        sources.store(dst, self.sources[0])
+        st = os.stat(self.sources[0])
+        self.assertEquals(sources.get(dst), (st.st_size, st.st_mtime))
+        self.assertRaises(CacheError, sources.store, dst, os.path.join(self.root, 'missing.mp3'))
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(transcode_cache)
@@ -0,0 +1,84 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from musa.cleanup import TreeCleanup
+from musa.walker import TreeWalker
+
+TEST_FILES = {
+    'Artist/Album/01 Track.mp3': 'audio\n',
+    'Artist/Album/playlist.m3u': '01 Track.mp3\n',
+    'Artist/Album/notes.txt': 'notes\n',
+    'Artist/Album/.musa-rename-0-01 Track': 'audio\n',
+    'Junk/Directory/info.txt': 'info\n',
+    '.musa-sync.json': '{}\n',
+}
+
+
+class tree_cleanup(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='musa-test-')
+        for path, data in TEST_FILES.items():
+            path = os.path.join(self.root, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').write(data)
+        os.makedirs(os.path.join(self.root, 'Empty'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def tree_paths(self):
+        paths = []
+        for root, directories, files in os.walk(self.root):
+            paths.extend(os.path.relpath(os.path.join(root, x), self.root) for x in directories + files)
+        return sorted(paths)
+
+    def cleanup(self, walker, dry_run=False):
+        cleanup = TreeCleanup(walker, dry_run=dry_run)
+        removed = [(kind, os.path.relpath(path, self.root), error) for kind, path, error in cleanup.run()]
+        return cleanup, removed
+
+    def test_dry_run(self):
+        paths = self.tree_paths()
+        cleanup, removed = self.cleanup(self.root, dry_run=True)
+        self.assertEquals(self.tree_paths(), paths)
+        self.assertEquals(removed, [
+            ('file', 'Artist/Album/notes.txt', None),
+            ('file', 'Junk/Directory/info.txt', None),
+            ('directory', 'Junk/Directory', None),
+            ('directory', 'Junk', None),
+            ('directory', 'Empty', None),
+        ])
+        self.assertEquals((cleanup.files_removed, cleanup.dirs_removed, cleanup.reclaimed), (2, 3, 11))
+
+    def test_cleanup(self):
+        cleanup, removed = self.cleanup(TreeWalker(self.root, threads=4))
+        self.assertEquals((cleanup.files_removed, cleanup.dirs_removed, cleanup.reclaimed), (2, 3, 11))
+        # Sync manifests and files staged by bulk renames are kept
+        self.assertEquals(self.tree_paths(), [
+            '.musa-sync.json',
+            'Artist',
+            'Artist/Album',
+            'Artist/Album/.musa-rename-0-01 Track',
+            'Artist/Album/01 Track.mp3',
+            'Artist/Album/playlist.m3u',
+        ])
+
+        cleanup, removed = self.cleanup(self.root)
+        self.assertEquals(removed, [])
+
+    def test_root(self):
+        shutil.rmtree(os.path.join(self.root, 'Artist'))
+        os.unlink(os.path.join(self.root, '.musa-sync.json'))
+        cleanup, removed = self.cleanup(self.root)
+        # Tree root is kept when left empty
+        self.assertEquals(self.tree_paths(), [])
+        self.assertTrue(os.path.isdir(self.root))
+        self.assertEquals(cleanup.dirs_removed, 3)
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(tree_cleanup)
@@ -0,0 +1,165 @@
+
+import os
+import sys
+import time
+import random
+import unittest
+import StringIO
+
+from xml.etree import ElementTree
+
+from soundforest.tags.xmltag import XMLTags
+from musa.cli import MusaThreadManager, ScriptError, ordered_map, XMLTrackStream
+
+
+class job(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def run(self):
+        if self.value == 'error':
+            raise ValueError('Invalid value')
+        if self.value == 'exit':
+            sys.exit(1)
+        if self.value == 'pid':
+            raise ValueError('%d' % os.getpid())
+        if self.value == 'unicode':
+            raise ValueError(u'Invalid path /tmp/\xe4')
+        if self.value == 'bytes':
+            raise ValueError('Invalid path /tmp/\xc3')
+
+
+class job_manager(MusaThreadManager):
+
+    def get_entry_handler(self, index, entry):
+        return job(entry)
+
+
+class thread_manager(unittest.TestCase):
+
+    def run_jobs(self, entries, **kwargs):
+        manager = job_manager('test', 3, **kwargs)
+        for entry in entries:
+            manager.enqueue(entry)
+        results = manager.run()
+        self.assertEquals(len(manager), 0)
+        return dict((r.entry, r) for r in results), manager
+
+    def test_threads(self):
+        results, manager = self.run_jobs(['a', 'error', 'b', 'exit', 'c'])
+        self.assertEquals(sorted(results.keys()), ['a', 'b', 'c', 'error', 'exit'])
+        self.assertTrue(results['a'].ok)
+        self.assertEquals(results['error'].error, 'Invalid value')
+        self.assertEquals(results['exit'].error, 'exit 1')
+        self.assertEquals(sorted(r.entry for r in manager.errors), ['error', 'exit'])
+        self.assertEquals(sorted(r.index for r in results.values()), ['%d/5' % i for i in range(1, 6)])
+
+    def test_processes(self):
+        results, manager = self.run_jobs(['a', 'error', 'exit', 'pid'], executor='processes')
+        self.assertEquals(manager.executor, 'processes')
+        self.assertTrue(results['a'].ok)
+        self.assertEquals(results['error'].error, 'Invalid value')
+        self.assertEquals(results['exit'].error, 'exit 1')
+        # Jobs are run in forked worker processes
+        self.assertNotEquals(results['pid'].error, '%d' % os.getpid())
+
+    def test_unicode_errors(self):
+        # Non-ascii messages don't stop the workers
+        results, manager = self.run_jobs(['unicode', 'bytes', 'a'])
+        self.assertEquals(results['unicode'].error, u'Invalid path /tmp/\xe4')
+        self.assertEquals(results['bytes'].error, 'Invalid path /tmp/\xc3')
+        self.assertTrue(results['a'].ok)
+
+    def test_unknown_executor(self):
+        self.assertRaises(ScriptError, job_manager, 'test', 1, executor='fibers')
+
+    def test_empty(self):
+        self.assertEquals(job_manager('test', 2).run(), [])
+
+
+
+
+class ordered_map_results(unittest.TestCase):
+
+    def test_order(self):
+        def square(value):
+            # Random delays complete items out of order
+            time.sleep(random.random() / 1000)
+            return value * value
+
+        for threads in (1, 4):
+            results = list(ordered_map(square, range(50), threads, window=8))
+            self.assertEquals([item for item, result, error in results], range(50))
+            self.assertEquals([result for item, result, error in results], [x * x for x in range(50)])
+            self.assertEquals([error for item, result, error in results], [None] * 50)
+
+    def test_errors(self):
+        def check(value):
+            if value % 3 == 0:
+                raise ValueError('Invalid value %d' % value)
+            if value == 4:
+                raise SystemExit(1)
+            return value
+
+        results = list(ordered_map(check, range(7), 3))
+        self.assertEquals([item for item, result, error in results], range(7))
+        self.assertEquals(results[1], (1, 1, None))
+        self.assertEquals(results[3], (3, None, 'Invalid value 3'))
+        self.assertEquals(results[4], (4, None, 'exit 1'))
+
+    def test_unicode_error(self):
+        def check(value):
+            raise ValueError(u'Invalid path /tmp/\xe4')
+
+        results = list(ordered_map(check, ['a'], 1))
+        self.assertEquals(results, [('a', None, u'Invalid path /tmp/\xe4')])
+
+    def test_window(self):
+        consumed = []
+
+        def items():
+            for x in range(20):
+                consumed.append(x)
+                yield x
+
+        for item, result, error in ordered_map(lambda x: x, items(), 4, window=3):
+            # Items are read from iterator only when there is room in window
+            self.assertTrue(len(consumed) <= item + 3)
+
+
+class xml_track_stream(unittest.TestCase):
+
+    def parse(self, stream):
+        return ElementTree.fromstring(stream.getvalue())
+
+    def test_tracks(self):
+        stream = StringIO.StringIO()
+        xmltree = XMLTrackStream(stream)
+        xmltree.append(XMLTags({'artist': [u'Sigur R\xf3s'], 'title': [u'Hopp\xedpolla']}))
+        # Tracks are written as they are appended
+        self.assertTrue('<track>' in stream.getvalue())
+        xmltree.append(XMLTags({'artist': [u'Artist']}))
+        xmltree.close()
+
+        root = self.parse(stream)
+        self.assertEquals(root.tag, 'soundforest')
+        tracks = root.find('tracks')
+        # Number of tracks is not known when tracks element is written
+        self.assertEquals(tracks.attrib, {})
+        self.assertEquals(len(tracks), 2)
+        self.assertEquals(tracks[0].find('artist').text, u'Sigur R\xf3s')
+        self.assertEquals(tracks[0].find('title').text, u'Hopp\xedpolla')
+        self.assertEquals(tracks[1].find('artist').text, u'Artist')
+
+    def test_empty(self):
+        stream = StringIO.StringIO()
+        XMLTrackStream(stream).close()
+        self.assertEquals(len(self.parse(stream).find('tracks')), 0)
+
+
+suite = unittest.TestSuite([
+    unittest.TestLoader().loadTestsFromTestCase(thread_manager),
+    unittest.TestLoader().loadTestsFromTestCase(ordered_map_results),
+    unittest.TestLoader().loadTestsFromTestCase(xml_track_stream),
+])
@@ -0,0 +1,119 @@
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from musa import CommandPathCache
+
+
+class command_path_cache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='musa-test-')
+        self.cache_path = os.path.join(self.root, 'cache', 'commands.json')
+        self.directories = [os.path.join(self.root, x) for x in ('bin1', 'bin2', 'bin3')]
+        for directory in self.directories:
+            os.makedirs(directory)
+        self.command(self.directories[0], 'flac')
+        self.command(self.directories[1], 'lame')
+        self.command(self.directories[2], 'flac')
+        # Files without execute permission are not commands
+        open(os.path.join(self.directories[2], 'notes'), 'w').write('\n')
+        # Whole second mtimes are restored exactly by os.utime in tests
+        for directory in self.directories:
+            os.utime(directory, (1000000000, 1000000000))
+
+        self.path = os.environ.get('PATH')
+        os.environ['PATH'] = os.pathsep.join(self.directories)
+
+    def tearDown(self):
+        if self.path is not None:
+            os.environ['PATH'] = self.path
+        shutil.rmtree(self.root)
+
+    def command(self, directory, name):
+        path = os.path.join(directory, name)
+        open(path, 'w').write('#!/bin/sh\n')
+        os.chmod(path, 0755)
+        return path
+
+    def test_which(self):
+        cache = CommandPathCache(self.cache_path)
+        self.assertEquals(cache.which('flac'), os.path.join(self.directories[0], 'flac'))
+        # Scanning stops at first directory with the command
+        self.assertEquals(cache.scanned, 1)
+        self.assertEquals(cache.which('lame'), os.path.join(self.directories[1], 'lame'))
+        self.assertEquals(cache.scanned, 2)
+        self.assertEquals(cache.which('notes'), None)
+        self.assertEquals(cache.scanned, 3)
+
+    def test_versions(self):
+        cache = CommandPathCache(self.cache_path)
+        self.assertEquals(cache.versions('flac'), [
+            os.path.join(self.directories[0], 'flac'),
+            os.path.join(self.directories[2], 'flac'),
+        ])
+
+    def test_cached_listing(self):
+        CommandPathCache(self.cache_path).versions('flac')
+        cached = json.load(open(self.cache_path))
+        self.assertEquals(sorted(cached.keys()), self.directories)
+
+        # Listing with unchanged directory mtime is read from cache
+        cached[self.directories[0]]['commands'] = ['cached']
+        json.dump(cached, open(self.cache_path, 'w'))
+        mtime = os.stat(self.directories[0]).st_mtime
+        self.command(self.directories[0], 'cached')
+        os.utime(self.directories[0], (mtime, mtime))
+        cache = CommandPathCache(self.cache_path)
+        self.assertEquals(cache.which('cached'), os.path.join(self.directories[0], 'cached'))
+        self.assertEquals(cache.which('flac'), os.path.join(self.directories[2], 'flac'))
+
+    def test_cached_missing(self):
+        notes = os.path.join(self.directories[2], 'notes')
+        CommandPathCache(self.cache_path).versions('flac')
+
+        # Commands removed or made executable without directory mtime change
+        mtime = os.stat(self.directories[0]).st_mtime
+        os.unlink(os.path.join(self.directories[0], 'flac'))
+        os.utime(self.directories[0], (mtime, mtime))
+        os.chmod(notes, 0755)
+        cache = CommandPathCache(self.cache_path)
+        self.assertEquals(cache.which('flac'), os.path.join(self.directories[2], 'flac'))
+        self.assertEquals(cache.which('notes'), notes)
+        self.assertEquals(cache.versions('flac'), [os.path.join(self.directories[2], 'flac')])
+
+    def test_cached_miss(self):
+        CommandPathCache(self.cache_path).versions('flac')
+
+        # Missing commands don't list directories with valid cached listings
+        cache = CommandPathCache(self.cache_path)
+        self.assertEquals(cache.which('missing'), None)
+        self.assertEquals(cache.versions('missing'), [])
+        self.assertEquals(cache.listed, set())
+
+    def test_stale_listing(self):
+        CommandPathCache(self.cache_path).versions('flac')
+        cached = json.load(open(self.cache_path))
+        cached[self.directories[0]]['commands'] = ['cached']
+        cached[self.directories[0]]['mtime'] -= 10
+        json.dump(cached, open(self.cache_path, 'w'))
+
+        # Directory modified after caching is listed again
+        cache = CommandPathCache(self.cache_path)
+        self.assertEquals(cache.which('cached'), None)
+        self.assertEquals(cache.which('flac'), os.path.join(self.directories[0], 'flac'))
+        self.assertEquals(json.load(open(self.cache_path))[self.directories[0]]['commands'], ['flac'])
+
+    def test_corrupt_cache(self):
+        os.makedirs(os.path.dirname(self.cache_path))
+        open(self.cache_path, 'w').write('{corrupt')
+        cache = CommandPathCache(self.cache_path)
+        self.assertEquals(cache.cached, {})
+        self.assertEquals(cache.which('lame'), os.path.join(self.directories[1], 'lame'))
+        self.assertEquals(sorted(json.load(open(self.cache_path)).keys()), self.directories[:2])
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(command_path_cache)
@@ -0,0 +1,235 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mutagen.easyid3 import EasyID3
+from soundforest.models import SoundforestDB, TrackModel, TagModel
+from soundforest.tree import Track
+from musa.database import TrackUpdateBatch, TreeUpdater, tag_models
+from musa.search import SearchError
+
+# MPEG audio frame header for 128kbit 44.1kHz stereo, frames are 417 bytes
+MP3_FRAME = '\xff\xfb\x90\x64' + '\x00' * 413
+
+TEST_TRACKS = [
+    'Artist/Album/01 First.mp3',
+    'Artist/Album/02 Second.mp3',
+    'Artist/Other/01 Other.mp3',
+]
+
+
+def write_track(path):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'wb').write(MP3_FRAME * 10)
+
+
+def tag_track(path, **tags):
+    id3 = EasyID3()
+    for tag, values in tags.items():
+        id3[tag] = values
+    id3.save(path)
+
+
+class failing_index(object):
+    """
+    Search index with failing updates
+    """
+    def __init__(self):
+        self.built = True
+
+    def update(self, tracks=(), removed=()):
+        raise SearchError('Error updating search index')
+
+    def invalidate(self):
+        self.built = False
+
+
+class tree_updater_fixture(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='musa-test-')
+        self.path = os.path.join(self.root, 'tree')
+        for path in TEST_TRACKS:
+            write_track(os.path.join(self.path, path))
+
+        self.db = SoundforestDB(path=os.path.join(self.root, 'musa.sqlite'))
+        self.db.register_tree(self.path)
+        self.db_tree = self.db.get_tree(self.path)
+
+    def tearDown(self):
+        self.db.session.close()
+        shutil.rmtree(self.root)
+
+    def update(self, **kwargs):
+        return TreeUpdater(self.db, self.db_tree, **kwargs).update()
+
+    def db_paths(self):
+        self.db.session.expire_all()
+        return sorted(
+            os.path.relpath(os.path.join(t.directory, t.filename), self.path)
+            for t in self.db.query(TrackModel).filter(TrackModel.tree_id == self.db_tree.id)
+        )
+
+    def db_tags(self, path):
+        self.db.session.expire_all()
+        db_track = self.db.query(TrackModel).filter(
+            TrackModel.directory == os.path.dirname(os.path.join(self.path, path)),
+            TrackModel.filename == os.path.basename(path)
+        ).one()
+        return sorted((t.tag, t.value) for t in self.db.query(TagModel).filter(TagModel.track_id == db_track.id))
+
+
+class tree_updater(tree_updater_fixture):
+
+    def test_add(self):
+        self.assertEquals(self.update(), (3, 0, 0))
+        self.assertEquals(self.db_paths(), sorted(TEST_TRACKS))
+        self.assertEquals(self.update(), (0, 0, 0))
+
+    def test_modify(self):
+        self.update()
+        path = os.path.join(self.path, TEST_TRACKS[0])
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+        self.assertEquals(self.update(), (0, 1, 0))
+        self.assertEquals(self.update(full=True), (0, 3, 0))
+
+    def test_quick(self):
+        self.update()
+        path = os.path.join(self.path, TEST_TRACKS[0])
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+        # Album directory mtime did not change
+        self.assertEquals(self.update(quick=True), (0, 0, 0))
+        self.assertEquals(self.update(), (0, 1, 0))
+
+    def test_remove(self):
+        self.update()
+        os.unlink(os.path.join(self.path, TEST_TRACKS[0]))
+        shutil.rmtree(os.path.join(self.path, 'Artist/Other'))
+        self.assertEquals(self.update(), (0, 0, 2))
+        self.assertEquals(self.db_paths(), [TEST_TRACKS[1]])
+
+    def test_tags(self):
+        path = os.path.join(self.path, TEST_TRACKS[0])
+        tag_track(path, artist=[u'Artist'], title=[u'First'])
+        self.assertEquals(self.update(), (3, 0, 0))
+        self.assertEquals(self.db_tags(TEST_TRACKS[0]), [('artist', u'Artist'), ('title', u'First')])
+        self.assertEquals(self.db_tags(TEST_TRACKS[1]), [])
+
+        tag_track(path, artist=[u'Other'])
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+        self.assertEquals(self.update(), (0, 1, 0))
+        self.assertEquals(self.db_tags(TEST_TRACKS[0]), [('artist', u'Other')])
+
+
+class tree_updater_scope(tree_updater_fixture):
+
+    def test_top_directories(self):
+        updater = TreeUpdater(self.db, self.db_tree, directories=[
+            os.path.join(self.path, 'Artist/Album'),
+            os.path.join(self.path, 'Artist') + os.sep,
+            os.path.join(self.path, 'Another'),
+        ])
+        self.assertEquals(updater.directories, [
+            os.path.join(self.path, 'Another'),
+            os.path.join(self.path, 'Artist'),
+        ])
+        self.assertTrue(updater.in_scope(os.path.join(self.path, 'Artist/Other')))
+        self.assertFalse(updater.in_scope(os.path.join(self.path, 'Artists')))
+
+    def test_scope(self):
+        self.update()
+        os.unlink(os.path.join(self.path, TEST_TRACKS[0]))
+        shutil.rmtree(os.path.join(self.path, 'Artist/Other'))
+        write_track(os.path.join(self.path, 'Artist/Album/03 Third.mp3'))
+
+        # Albums outside scope are not removed
+        directory = os.path.join(self.path, 'Artist/Album')
+        self.assertEquals(self.update(directories=[directory]), (1, 0, 1))
+        self.assertEquals(self.db_paths(), [
+            'Artist/Album/02 Second.mp3',
+            'Artist/Album/03 Third.mp3',
+            'Artist/Other/01 Other.mp3',
+        ])
+
+        # Removed directory in scope
+        self.assertEquals(self.update(directories=[os.path.join(self.path, 'Artist/Other')]), (0, 0, 1))
+
+    def test_scope_wildcards(self):
+        # LIKE wildcards in scope directory do not match other albums
+        write_track(os.path.join(self.path, 'A_B/Album/01 Track.mp3'))
+        write_track(os.path.join(self.path, 'AxB/Album/01 Track.mp3'))
+        self.update()
+        shutil.rmtree(os.path.join(self.path, 'AxB'))
+        self.assertEquals(self.update(directories=[os.path.join(self.path, 'A_B')]), (0, 0, 0))
+        self.assertTrue('AxB/Album/01 Track.mp3' in self.db_paths())
+
+    def test_scope_tags(self):
+        # Watched directory updates store tags of tagged tracks
+        self.update()
+        path = os.path.join(self.path, TEST_TRACKS[1])
+        tag_track(path, artist=[u'Artist'], title=[u'Second'])
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+        tag_track(os.path.join(self.path, TEST_TRACKS[2]), title=[u'Other'])
+
+        self.assertEquals(self.update(directories=[os.path.join(self.path, 'Artist/Album')]), (0, 1, 0))
+        self.assertEquals(self.db_tags(TEST_TRACKS[1]), [('artist', u'Artist'), ('title', u'Second')])
+        self.assertEquals(self.db_tags(TEST_TRACKS[2]), [])
+
+
+class track_update_batch(tree_updater_fixture):
+
+    def test_flush(self):
+        self.update()
+        path = os.path.join(self.path, TEST_TRACKS[0])
+        tag_track(path, artist=[u'Artist'], title=[u'Title'])
+
+        batch = TrackUpdateBatch(self.db, batch_size=0)
+        batch.append(Track(path))
+        self.assertEquals(self.db_tags(TEST_TRACKS[0]), [])
+        self.assertEquals(batch.flush(), 1)
+        self.assertEquals(self.db_tags(TEST_TRACKS[0]), [('artist', u'Artist'), ('title', u'Title')])
+
+        tag_track(path, artist=[u'Other'])
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+        batch.append(Track(path))
+        batch.flush()
+        self.assertEquals(self.db_tags(TEST_TRACKS[0]), [('artist', u'Other')])
+        self.assertEquals(batch.updated, 2)
+        # Stored mtime matches edited file, incremental update skips it
+        self.assertEquals(self.update(), (0, 0, 0))
+
+    def test_index_error(self):
+        # Index failures don't fail committed database updates
+        index = failing_index()
+        self.assertEquals(self.update(index=index), (len(TEST_TRACKS), 0, 0))
+        self.assertFalse(index.built)
+
+        index = failing_index()
+        batch = TrackUpdateBatch(self.db, batch_size=0, index=index)
+        batch.append(Track(os.path.join(self.path, TEST_TRACKS[0])))
+        self.assertEquals(batch.flush(), 1)
+        self.assertFalse(index.built)
+        self.assertEquals(batch.index, None)
+
+    def test_tag_models(self):
+        # Multi-valued tags are stored as one row per value
+        models = tag_models(1, {'artist': [u'First', u'Second'], 'title': u'Title'})
+        self.assertEquals(
+            sorted((m.track_id, m.tag, m.value) for m in models),
+            [(1, 'artist', u'First'), (1, 'artist', u'Second'), (1, 'title', u'Title')]
+        )
+
+
+suite = unittest.TestSuite([
+    unittest.TestLoader().loadTestsFromTestCase(tree_updater),
+    unittest.TestLoader().loadTestsFromTestCase(tree_updater_scope),
+    unittest.TestLoader().loadTestsFromTestCase(track_update_batch),
+])
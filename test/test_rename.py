@@ -0,0 +1,164 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from musa.rename import RenamePlan, RenameJournal, RenameError, bulk_rename, \
+    remove_empty_directories, pending_journals, path_below, STAGING_PREFIX
+
+
+class rename_fixture(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='musa-test-')
+        self.journals = os.path.join(self.root, 'journals')
+        for name in ('a', 'b', 'c'):
+            open(self.path(name), 'w').write(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def contents(self, name):
+        return open(self.path(name)).read()
+
+    def moves(self, *names):
+        return [(self.path(src), self.path(dst)) for src, dst in names]
+
+
+class rename_plan(rename_fixture):
+
+    def test_chain(self):
+        plan = RenamePlan(self.moves(('a', 'b'), ('b', 'd')))
+        self.assertEquals(plan.operations, [
+            ('rename', self.path('b'), self.path('d')),
+            ('rename', self.path('a'), self.path('b')),
+        ])
+        self.assertEquals(plan.cycles, 0)
+
+    def test_cycle(self):
+        plan = RenamePlan(self.moves(('a', 'b'), ('b', 'c'), ('c', 'a')), token='test')
+        staged = os.path.join(self.root, '%stest-0' % STAGING_PREFIX)
+        self.assertEquals(plan.cycles, 1)
+        self.assertEquals(plan.operations, [
+            ('rename', self.path('a'), staged),
+            ('rename', self.path('c'), self.path('a')),
+            ('rename', self.path('b'), self.path('c')),
+            ('rename', staged, self.path('b')),
+        ])
+
+        bulk_rename(self.moves(('a', 'b'), ('b', 'c'), ('c', 'a')), self.journals)
+        self.assertEquals([self.contents(x) for x in ('a', 'b', 'c')], ['c', 'a', 'b'])
+        self.assertEquals(pending_journals(self.journals), [])
+
+    def test_directories(self):
+        plan = RenamePlan(self.moves(('a', 'x/y/a'), ('b', 'x/b')))
+        self.assertEquals(plan.operations[:2], [
+            ('mkdir', None, self.path('x')),
+            ('mkdir', None, self.path('x/y')),
+        ])
+        self.assertEquals(len(plan), 2)
+
+    def test_unchanged(self):
+        plan = RenamePlan(self.moves(('a', 'a')))
+        self.assertEquals(len(plan), 0)
+        self.assertEquals(plan.operations, [])
+
+    def test_collisions(self):
+        self.assertRaises(RenameError, RenamePlan, self.moves(('a', 'd'), ('b', 'd')))
+        self.assertRaises(RenameError, RenamePlan, self.moves(('a', 'd'), ('a', 'e')))
+        self.assertRaises(RenameError, RenamePlan, self.moves(('a', 'c')))
+        self.assertRaises(RenameError, RenamePlan, self.moves(('missing', 'd')))
+
+
+class rename_journal(rename_fixture):
+
+    def interrupted_run(self):
+        """
+        Run a journal failing on second rename
+        """
+        plan = RenamePlan(self.moves(('a', 'd'), ('b', 'e')))
+        journal = RenameJournal.create(plan, self.journals)
+        # Other file created in target path after planning
+        open(self.path('e'), 'w').write('x')
+        self.assertRaises(RenameError, journal.run)
+        return journal
+
+    def test_resume(self):
+        journal = self.interrupted_run()
+        self.assertEquals(pending_journals(self.journals), [journal.path])
+
+        loaded = RenameJournal.load(journal.path)
+        self.assertEquals(loaded.operations, journal.operations)
+        self.assertEquals(loaded.completed, 1)
+
+        os.unlink(self.path('e'))
+        loaded.run()
+        self.assertEquals([self.contents(x) for x in ('d', 'e')], ['a', 'b'])
+        self.assertEquals(pending_journals(self.journals), [])
+
+    def test_rollback(self):
+        journal = self.interrupted_run()
+        RenameJournal.load(journal.path).rollback()
+        self.assertEquals([self.contents(x) for x in ('a', 'b', 'e')], ['a', 'b', 'x'])
+        self.assertFalse(os.path.exists(self.path('d')))
+        self.assertEquals(pending_journals(self.journals), [])
+
+    def test_unrecorded_operation(self):
+        # Operation done before process was interrupted is detected on resume
+        plan = RenamePlan(self.moves(('a', 'd'), ('b', 'e')))
+        journal = RenameJournal.create(plan, self.journals)
+        os.rename(self.path('a'), self.path('d'))
+
+        loaded = RenameJournal.load(journal.path)
+        self.assertEquals(loaded.completed, 0)
+        loaded.run()
+        self.assertEquals([self.contents(x) for x in ('d', 'e')], ['a', 'b'])
+
+    def test_invalid_journal(self):
+        path = os.path.join(self.root, 'invalid.journal')
+        open(path, 'w').write('{invalid\n')
+        self.assertRaises(RenameError, RenameJournal.load, path)
+
+    def test_bulk_rename_rollback(self):
+        # Directory x is created for x/a, so renaming file b to x fails
+        self.assertRaises(RenameError, bulk_rename, self.moves(('a', 'x/a'), ('b', 'x')), self.journals)
+        self.assertEquals([self.contents(x) for x in ('a', 'b', 'c')], ['a', 'b', 'c'])
+        self.assertFalse(os.path.exists(self.path('x')))
+        self.assertEquals(pending_journals(self.journals), [])
+
+
+class rename_cleanup(rename_fixture):
+
+    def test_remove_empty_directories(self):
+        os.makedirs(self.path('tree/Artist/Album'))
+        os.makedirs(self.path('tree/Other/Album'))
+        open(self.path('tree/Other/Album/01 Track.mp3'), 'w').write('\n')
+
+        removed = remove_empty_directories(
+            [self.path('tree/Artist/Album'), self.path('tree/Other/Album'), self.path('outside')],
+            [self.path('tree')]
+        )
+        self.assertEquals(removed, [self.path('tree/Artist/Album'), self.path('tree/Artist')])
+        self.assertTrue(os.path.isdir(self.path('tree/Other/Album')))
+        self.assertEquals(remove_empty_directories([self.path('tree')], [self.path('tree')]), [])
+        self.assertTrue(os.path.isdir(self.path('tree')))
+
+    def test_path_below(self):
+        root = self.path('tree')
+        self.assertEquals(path_below(root, 'Artist/Album/01 Track.mp3'), self.path('tree/Artist/Album/01 Track.mp3'))
+        self.assertEquals(path_below(root + os.sep, '..Artist/Album/01 ..mp3'), self.path('tree/..Artist/Album/01 ..mp3'))
+        # Paths formatted from empty or dot tags are not renamed outside tree
+        for path in ('/Album/01 Track.mp3', 'Artist//01 Track.mp3', '../../01 Track.mp3',
+                     'Artist/./01 Track.mp3', '/etc/passwd', '..'):
+            self.assertRaises(RenameError, path_below, root, path)
+
+
+suite = unittest.TestSuite([
+    unittest.TestLoader().loadTestsFromTestCase(rename_plan),
+    unittest.TestLoader().loadTestsFromTestCase(rename_journal),
+    unittest.TestLoader().loadTestsFromTestCase(rename_cleanup),
+])
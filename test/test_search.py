@@ -0,0 +1,83 @@
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from soundforest.models import SoundforestDB
+from musa.search import SearchIndex, SearchError, existing_index
+
+
+class search_query(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='musa-test-')
+        self.index = SearchIndex(os.path.join(self.root, 'search.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_words(self):
+        self.assertEquals(self.index.parse_query('pink floyd'), u'"pink"* AND "floyd"*')
+        self.assertEquals(self.index.parse_query(u'sigur r\xf3s'), u'"sigur"* AND "r\xf3s"*')
+        self.assertEquals(self.index.parse_query('-- ,'), u'')
+
+    def test_fields(self):
+        self.assertEquals(self.index.parse_query('Artist:floyd'), u'artist : "floyd"*')
+        self.assertEquals(self.index.parse_query('artist:"pink floyd" wall'), u'artist : "pink floyd"* AND "wall"*')
+        # Unknown field names are matched as words
+        self.assertEquals(self.index.parse_query('foo:bar'), u'"foo bar"*')
+
+    def test_invalid_query(self):
+        self.assertRaises(SearchError, self.index.parse_query, 'artist:"pink')
+
+    def test_search(self):
+        self.assertFalse(self.index.built)
+        self.index.update([
+            (1, 1, u'/music/a.mp3', {'artist': [u'Pink Floyd'], 'title': [u'Wish You Were Here']}),
+            (2, 1, u'/music/b.mp3', {'artist': [u'Pinkerton'], 'title': [u'Floyd']}),
+        ])
+        self.assertEquals(len(self.index), 2)
+        self.assertEquals(sorted(self.index.search('pink')), [(1, u'/music/a.mp3'), (2, u'/music/b.mp3')])
+        self.assertEquals(self.index.search('artist:floyd'), [(1, u'/music/a.mp3')])
+
+        self.index.update(removed=[1])
+        self.assertEquals(self.index.search('artist:floyd'), [])
+
+    def test_rebuild(self):
+        # Index updated before a full build is not marked built
+        self.index.update([(1, 1, u'/music/a.mp3', {'artist': [u'Pink Floyd']})])
+        self.assertFalse(self.index.built)
+
+        db = SoundforestDB(path=os.path.join(self.root, 'musa.sqlite'))
+        self.assertEquals(self.index.rebuild(db), 0)
+        self.assertTrue(self.index.built)
+        self.assertEquals(len(self.index), 0)
+        db.session.close()
+
+        self.index.invalidate()
+        self.assertFalse(self.index.built)
+
+    def test_schema_version(self):
+        # Index with older schema is recreated
+        path = os.path.join(self.root, 'old.sqlite')
+        connection = sqlite3.connect(path)
+        connection.execute('CREATE VIRTUAL TABLE tracks USING fts5 (track_id UNINDEXED, tags)')
+        connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        connection.execute("INSERT INTO meta VALUES ('built', 'yes')")
+        connection.commit()
+        connection.close()
+
+        index = SearchIndex(path)
+        self.assertFalse(index.built)
+        index.update([(5, 1, u'/music/a.mp3', {'artist': [u'Pink Floyd']})])
+        self.assertEquals(index.search('floyd'), [(5, u'/music/a.mp3')])
+
+    def test_existing_index(self):
+        self.assertEquals(existing_index(os.path.join(self.root, 'missing.sqlite')), None)
+        self.index.update([])
+        self.assertEquals(existing_index(self.index.path).path, self.index.path)
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(search_query)
@@ -0,0 +1,178 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from musa.sync import FilesystemSyncThread, RsyncThread, SyncManifest, SyncError, SYNC_MANIFEST, \
+    RE_RSYNC_PROGRESS, RE_RSYNC_STATS
+
+
+class sync_manager(object):
+    walker_threads = 1
+
+
+class sync_manifest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='musa-test-')
+        self.entries = {
+            u'Artist/Album/01 Track.flac': {'path': u'Artist/Album/01 Track.mp3', 'size': 100, 'mtime': 1},
+            u'Artist/Album/02 Track.flac': {'path': u'Artist/Album/02 Track.mp3', 'size': 200, 'mtime': 2},
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_missing_manifest(self):
+        manifest = SyncManifest(self.root)
+        manifest.load()
+        self.assertEquals(len(manifest), 0)
+
+    def test_save_load(self):
+        manifest = SyncManifest(self.root)
+        manifest.save(self.entries)
+        self.assertEquals(manifest, self.entries)
+        self.assertTrue(os.path.isfile(os.path.join(self.root, SYNC_MANIFEST)))
+        self.assertFalse(os.path.isfile('%s.tmp' % manifest.path))
+
+        manifest = SyncManifest(self.root)
+        manifest.load()
+        self.assertEquals(manifest, self.entries)
+
+    def test_invalid_manifest(self):
+        open(os.path.join(self.root, SYNC_MANIFEST), 'w').write('{invalid')
+        manifest = SyncManifest(self.root)
+        manifest.load()
+        self.assertEquals(len(manifest), 0)
+
+    def test_save_error(self):
+        manifest = SyncManifest(os.path.join(self.root, 'missing'))
+        self.assertRaises(SyncError, manifest.save, self.entries)
+
+
+class sync_remove_stale(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='musa-test-')
+        self.src = os.path.join(self.root, 'src')
+        self.dst = os.path.join(self.root, 'dst')
+        for path in ('Artist/Album/01 Track.mp3', 'Artist/Old/01 Track.mp3', 'Other/Album/01 Track.mp3'):
+            path = os.path.join(self.dst, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').write('\n')
+        os.makedirs(self.src)
+        self.expected = set([u'Artist/Album/01 Track.mp3'])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def sync_thread(self, dry_run=False, verify=False):
+        return FilesystemSyncThread(sync_manager(), 0, self.src, self.dst, delete=True,
+            dry_run=dry_run, verify=verify)
+
+    def dst_files(self):
+        files = []
+        for root, dirs, filenames in os.walk(self.dst):
+            files.extend(os.path.relpath(os.path.join(root, x), self.dst) for x in filenames)
+        return sorted(files)
+
+    def test_walk_destination(self):
+        self.sync_thread().remove_stale({}, self.expected)
+        self.assertEquals(self.dst_files(), ['Artist/Album/01 Track.mp3'])
+        self.assertFalse(os.path.isdir(os.path.join(self.dst, 'Artist/Old')))
+        self.assertFalse(os.path.isdir(os.path.join(self.dst, 'Other')))
+        self.assertTrue(os.path.isdir(self.dst))
+
+    def test_manifest(self):
+        # Only tracks synced earlier are removed
+        manifest = {
+            u'Artist/Album/01 Track.flac': {'path': u'Artist/Album/01 Track.mp3'},
+            u'Artist/Old/01 Track.flac': {'path': u'Artist/Old/01 Track.mp3'},
+        }
+        self.sync_thread().remove_stale(manifest, self.expected)
+        self.assertEquals(self.dst_files(), ['Artist/Album/01 Track.mp3', 'Other/Album/01 Track.mp3'])
+
+    def test_verify(self):
+        manifest = {u'Artist/Album/01 Track.flac': {'path': u'Artist/Album/01 Track.mp3'}}
+        self.sync_thread(verify=True).remove_stale(manifest, self.expected)
+        self.assertEquals(self.dst_files(), ['Artist/Album/01 Track.mp3'])
+
+    def test_dry_run(self):
+        self.sync_thread(dry_run=True).remove_stale({}, self.expected)
+        self.assertEquals(len(self.dst_files()), 3)
+
+
+class rsync_output(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='musa-test-')
+        self.thread = RsyncThread(sync_manager(), 0, self.root, self.root, None, progress=True)
+        self.path = os.environ.get('PATH')
+
+    def tearDown(self):
+        if self.path is not None:
+            os.environ['PATH'] = self.path
+        shutil.rmtree(self.root)
+
+    def fake_rsync(self, script):
+        directory = os.path.join(self.root, 'bin')
+        os.makedirs(directory)
+        path = os.path.join(directory, 'rsync')
+        open(path, 'w').write('#!/bin/sh\n%s\n' % script)
+        os.chmod(path, 0755)
+        os.environ['PATH'] = os.pathsep.join([directory, self.path or ''])
+
+    def test_progress_regex(self):
+        m = RE_RSYNC_PROGRESS.match('    1,238,099  44%   12.34MB/s    0:00:02 (xfr#3, to-chk=12/20)')
+        self.assertEquals(m.group('bytes'), '1,238,099')
+        self.assertEquals(m.group('percent'), '44')
+        self.assertEquals(m.group('rate'), '12.34MB/s')
+        self.assertEquals(m.group('eta'), '0:00:02')
+        self.assertEquals((m.group('files'), m.group('remaining'), m.group('total')), ('3', '12', '20'))
+
+        m = RE_RSYNC_PROGRESS.match('          0   0%    0.00kB/s    0:00:00')
+        self.assertEquals(m.group('files'), None)
+        self.assertEquals(RE_RSYNC_PROGRESS.match('Artist/Album/01 Track.mp3'), None)
+
+    def test_stats_regex(self):
+        for line, key, value in (
+            ('Number of files: 1,204 (reg: 1,100, dir: 104)', 'Number of files', '1,204'),
+            ('Number of regular files transferred: 12', 'Number of regular files transferred', '12'),
+            ('Total file size: 8,012,345,678 bytes', 'Total file size', '8,012,345,678'),
+            ('Total bytes sent: 1,024', 'Total bytes sent', '1,024'),
+        ):
+            m = RE_RSYNC_STATS.match(line)
+            self.assertEquals((m.group('key'), m.group('value')), (key, value))
+        self.assertEquals(RE_RSYNC_STATS.match('sent 1,024 bytes  received 35 bytes'), None)
+
+    def test_parse_output(self):
+        self.assertTrue('--info=progress2' in self.thread.flags)
+        self.thread.parse_output('    1,238,099  44%   12.34MB/s    0:00:02 (xfr#3, to-chk=12/20)')
+        self.thread.parse_output('Number of regular files transferred: 1,012')
+        self.assertEquals(self.thread.progress['bytes'], 1238099)
+        self.assertEquals(self.thread.progress['percent'], 44)
+        self.assertEquals(self.thread.progress['remaining'], 12)
+        self.assertEquals(self.thread.stats, {'Number of regular files transferred': 1012})
+
+    def test_run(self):
+        self.fake_rsync('echo "Number of regular files transferred: 3"')
+        self.thread.run()
+        self.assertEquals(self.thread.stats, {'Number of regular files transferred': 3})
+
+    def test_run_error(self):
+        self.fake_rsync('echo "rsync: write failed: No space left on device" >&2; exit 11')
+        try:
+            self.thread.run()
+            self.fail('rsync error was not raised')
+        except SyncError, emsg:
+            self.assertTrue('failed with code 11' in str(emsg))
+        self.assertEquals(self.thread.errors, ['rsync: write failed: No space left on device'])
+
+
+suite = unittest.TestSuite([
+    unittest.TestLoader().loadTestsFromTestCase(sync_manifest),
+    unittest.TestLoader().loadTestsFromTestCase(sync_remove_stale),
+    unittest.TestLoader().loadTestsFromTestCase(rsync_output),
+])
@@ -0,0 +1,125 @@
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from collections import OrderedDict
+
+from mutagen.easyid3 import EasyID3
+from soundforest.tree import Track
+from musa.tagcache import TagCache, CachedTags, tag_updates
+
+# MPEG audio frame header for 128kbit 44.1kHz stereo, frames are 417 bytes
+MP3_FRAME = '\xff\xfb\x90\x64' + '\x00' * 413
+
+
+class tag_cache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='musa-test-')
+        self.cache = TagCache(os.path.join(self.root, 'tags.sqlite'))
+        self.track = os.path.join(self.root, 'track.mp3')
+        open(self.track, 'w').write('\n')
+        self.tags = OrderedDict([('title', [u'Title']), ('artist', [u'Artist']), ('album', [u'Album'])])
+
+    def tearDown(self):
+        self.cache.flush()
+        shutil.rmtree(self.root)
+
+    def test_store(self):
+        self.assertEquals(self.cache.get(self.track), None)
+        self.cache.store(self.track, self.tags)
+        tags = self.cache.get(self.track)
+        self.assertTrue(isinstance(tags, CachedTags))
+        self.assertEquals(tags.keys(), ['title', 'artist', 'album'])
+        self.assertEquals(tags.as_dict(), dict(self.tags))
+
+    def test_modified(self):
+        self.cache.store(self.track, self.tags)
+        open(self.track, 'a').write('modified')
+        self.assertEquals(self.cache.get(self.track), None)
+        self.assertEquals(self.cache.get(os.path.join(self.root, 'missing.mp3')), None)
+
+    def test_invalidate(self):
+        self.cache.store(self.track, self.tags)
+        self.cache.invalidate(self.track)
+        self.assertEquals(self.cache.get(self.track), None)
+
+    def test_real_path(self):
+        # Relative paths and symlinks share the entry of the real path
+        link = os.path.join(self.root, 'link.mp3')
+        os.symlink(self.track, link)
+        self.cache.store(link, self.tags)
+        self.assertEquals(self.cache.get(self.track).as_dict(), dict(self.tags))
+
+        cwd = os.getcwd()
+        os.chdir(self.root)
+        try:
+            self.assertEquals(self.cache.get('track.mp3').as_dict(), dict(self.tags))
+            self.cache.invalidate('./link.mp3')
+        finally:
+            os.chdir(cwd)
+        self.assertEquals(self.cache.get(self.track), None)
+
+    def test_json(self):
+        # One track per line for JSON Lines output
+        tags = CachedTags(self.track, 2, 0, [('artist', [u'Sigur R\xf3s']), ('title', [u'Title'])])
+        output = tags.to_json(indent=None).encode('utf-8')
+        self.assertFalse('\n' in output)
+        data = json.loads(output)
+        self.assertEquals(data['filename'], self.track)
+        self.assertEquals(data['size'], 2)
+        self.assertEquals(
+            [(tag['tag'], tag['values']) for tag in data['tags']],
+            [('artist', [u'Sigur R\xf3s']), ('title', [u'Title'])]
+        )
+
+    def test_flush(self):
+        self.cache.store(self.track, self.tags)
+        self.cache.invalidate(os.path.join(self.root, 'other.mp3'))
+        # Entries are committed in batches
+        self.assertEquals(self.cache.pending, 2)
+        self.cache.flush()
+        self.assertEquals(self.cache.pending, 0)
+
+        cache = TagCache(self.cache.path)
+        self.assertEquals(cache.get(self.track).as_dict(), dict(self.tags))
+
+
+class copy_tag_updates(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='musa-test-')
+        self.path = os.path.join(self.root, 'track.mp3')
+        open(self.path, 'wb').write(MP3_FRAME * 10)
+        id3 = EasyID3()
+        id3['artist'] = [u'Artist']
+        id3['title'] = [u'Title']
+        id3.save(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def cached(self, items):
+        return CachedTags(self.path, 0, 0, items)
+
+    def test_equal(self):
+        # Values loaded from cache match values parsed from target file
+        src = self.cached([('artist', [u'Artist']), ('title', u'Title')])
+        self.assertEquals(tag_updates(src, Track(self.path).tags), [])
+
+    def test_updates(self):
+        src = self.cached([('artist', [u'Other']), ('title', [u'Title']), ('album', [u'Album'])])
+        self.assertEquals(tag_updates(src, Track(self.path).tags), [
+            ('artist', [u'Artist'], [u'Other']),
+            ('album', None, [u'Album']),
+        ])
+        self.assertEquals(tag_updates(src, Track(self.path).tags, ignored=('artist', 'album')), [])
+
+
+suite = unittest.TestSuite([
+    unittest.TestLoader().loadTestsFromTestCase(tag_cache),
+    unittest.TestLoader().loadTestsFromTestCase(copy_tag_updates),
+])
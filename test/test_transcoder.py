@@ -0,0 +1,151 @@
+
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+from soundforest.tree import Track
+from musa.cache import TranscodeSources
+from musa.transcoder import TranscoderThread, TranscoderError, target_status, TARGET_FILE_MODE
+
+
+def fake_encoder(track, path):
+    # Writes stdin to the track path like encoders given '-' as input file
+    return ['sh', '-c', 'cat > "$0"', track.path]
+
+
+def failing_encoder(track, path):
+    return ['sh', '-c', 'cat > "$0"; exit 1', track.path]
+
+
+class transcoder_streaming(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='musa-test-')
+        os.makedirs(os.path.join(self.root, 'target'))
+        open(os.path.join(self.root, 'track.flac'), 'w').write('audio data\n')
+        self.src = Track(os.path.join(self.root, 'track.flac'))
+        self.src.get_decoder_command = lambda path: ['sh', '-c', 'cat "$0"', self.src.path]
+        self.dst = Track(os.path.join(self.root, 'target', 'track.mp3'))
+        self.thread = TranscoderThread('1/1', self.src, self.dst)
+
+    def tearDown(self):
+        if 'get_encoder_command' in Track.__dict__:
+            del Track.get_encoder_command
+        shutil.rmtree(self.root)
+
+    def target_files(self):
+        return os.listdir(os.path.dirname(self.dst.path))
+
+    def test_supports_streaming(self):
+        decoder = ['flac', '-d', '-c', '-']
+        self.assertTrue(self.thread.supports_streaming(decoder, ['lame', '-', 'track.mp3']))
+        self.assertTrue(self.thread.supports_streaming(decoder, ['/usr/bin/neroAacEnc', '-if', '-', '-of', 'track.m4a']))
+        # Two pass encoding reads input twice and needs a seekable file
+        self.assertFalse(self.thread.supports_streaming(decoder, ['neroAacEnc', '-2pass', '-if', '-', '-of', 'track.m4a']))
+        self.assertFalse(self.thread.supports_streaming(decoder, ['faac', '-', '-o', 'track.m4a']))
+        self.assertFalse(self.thread.supports_streaming(['mpg123', '-w', '-'], ['lame', '-', 'track.mp3']))
+        self.thread.streaming = False
+        self.assertFalse(self.thread.supports_streaming(decoder, ['lame', '-', 'track.mp3']))
+
+    def test_pipe(self):
+        output = os.path.join(self.root, 'output')
+        self.thread.pipe(self.src.get_decoder_command('-'), ['sh', '-c', 'cat > "$0"', output])
+        self.assertEquals(open(output).read(), 'audio data\n')
+
+    def test_pipe_errors(self):
+        encoder = ['sh', '-c', 'cat > /dev/null']
+        self.assertRaises(TranscoderError, self.thread.pipe, ['sh', '-c', 'exit 2'], encoder)
+        self.assertRaises(TranscoderError, self.thread.pipe, self.src.get_decoder_command('-'), ['sh', '-c', 'exit 1'])
+        self.assertRaises(TranscoderError, self.thread.pipe, [os.path.join(self.root, 'missing')], encoder)
+
+    def test_pipe_missing_encoder(self):
+        # Decoder is stopped when encoder can't be started
+        started = time.time()
+        self.assertRaises(TranscoderError, self.thread.pipe,
+            ['sh', '-c', 'sleep 30'], [os.path.join(self.root, 'missing')]
+        )
+        self.assertTrue(time.time() - started < 10)
+
+    def test_transcode_streaming(self):
+        paths = []
+
+        def encoder(track, path):
+            paths.append(track.path)
+            return fake_encoder(track, path)
+
+        Track.get_encoder_command = encoder
+        self.thread.transcode_streaming()
+        # Target is encoded to a temporary file in target directory
+        self.assertEquals(os.path.dirname(paths[0]), os.path.dirname(self.dst.path))
+        self.assertTrue(os.path.basename(paths[0]).startswith('.musa-'))
+        self.assertEquals(self.target_files(), ['track.mp3'])
+        self.assertEquals(open(self.dst.path).read(), 'audio data\n')
+        self.assertEquals(stat.S_IMODE(os.stat(self.dst.path).st_mode), TARGET_FILE_MODE)
+
+    def test_transcode_streaming_error(self):
+        Track.get_encoder_command = failing_encoder
+        self.assertRaises(TranscoderError, self.thread.transcode_streaming)
+        self.assertEquals(self.target_files(), [])
+
+
+class transcode_target_status(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='musa-test-')
+        self.src = os.path.join(self.root, 'track.flac')
+        self.dst = os.path.join(self.root, 'track.mp3')
+        open(self.src, 'w').write('audio data\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write_target(self, data='encoded\n', age=0):
+        open(self.dst, 'w').write(data)
+        # Target written after source, or age seconds before it
+        st = os.stat(self.src)
+        mtime = max(st.st_mtime, st.st_ctime) + 10 - age
+        os.utime(self.dst, (mtime, mtime))
+
+    def test_new(self):
+        self.assertEquals(target_status(self.src, self.dst), 'new')
+        self.assertEquals(target_status(self.src, self.dst, incremental=True), 'new')
+
+    def test_skipped(self):
+        self.write_target()
+        self.assertEquals(target_status(self.src, self.dst), None)
+        self.assertEquals(target_status(self.src, self.dst, incremental=True), None)
+        self.assertEquals(target_status(self.src, self.dst, overwrite=True), 'refreshed')
+
+    def test_empty_target(self):
+        self.write_target(data='')
+        self.assertEquals(target_status(self.src, self.dst), 'refreshed')
+
+    def test_incremental(self):
+        self.write_target(age=20)
+        self.assertEquals(target_status(self.src, self.dst), None)
+        self.assertEquals(target_status(self.src, self.dst, incremental=True), 'refreshed')
+
+    def test_changed_source_metadata(self):
+        # Permission changes update ctime only, target is not refreshed
+        self.write_target()
+        os.chmod(self.src, 0600)
+        self.assertEquals(target_status(self.src, self.dst, incremental=True), None)
+
+    def test_older_source_mtime(self):
+        # Source restored with older modification time after target was written
+        sources = TranscodeSources(os.path.join(self.root, 'sources.sqlite'))
+        self.write_target()
+        sources.store(self.dst, self.src)
+        self.assertEquals(target_status(self.src, self.dst, incremental=True, sources=sources), None)
+        os.utime(self.src, (0, 0))
+        self.assertEquals(target_status(self.src, self.dst, incremental=True), None)
+        self.assertEquals(target_status(self.src, self.dst, incremental=True, sources=sources), 'refreshed')
+
+
+suite = unittest.TestSuite([
+    unittest.TestLoader().loadTestsFromTestCase(transcoder_streaming),
+    unittest.TestLoader().loadTestsFromTestCase(transcode_target_status),
+])
@@ -0,0 +1,128 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from musa.walker import TreeWalker, MusaTree, list_directory
+
+TEST_FILE_PATHS = [
+    'B Artist/Album/01 Track.mp3',
+    'B Artist/Album/02 Track.mp3',
+    'B Artist/Album/cover.jpg',
+    'A Artist/Second/01 Track.flac',
+    'A Artist/First/01 Track.mp3',
+    'A Artist/First/CD1/01 Track.mp3',
+    'Empty/Directory/notes.txt',
+    'C Artist/Album/01 Track.m4a',
+]
+
+
+class counting_walker(TreeWalker):
+    """
+    Records the number of directories listed
+    """
+    def __init__(self, *args, **kwargs):
+        TreeWalker.__init__(self, *args, **kwargs)
+        self.listed = 0
+
+    def list(self, root):
+        listing = TreeWalker.list(self, root)
+        self.listed += 1
+        return listing
+
+
+class failing_walker(TreeWalker):
+    """
+    Raises ValueError when listing directories named Fail
+    """
+    def list(self, root):
+        if os.path.basename(root) == 'Fail':
+            raise ValueError('Listing failed: %s' % root)
+        return TreeWalker.list(self, root)
+
+
+class tree_walker(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='musa-test-')
+        for path in TEST_FILE_PATHS:
+            path = os.path.join(self.root, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').write('\n')
+        os.symlink(os.path.join(self.root, 'B Artist'), os.path.join(self.root, 'Link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def os_walk(self):
+        result = []
+        for root, dirs, files in os.walk(self.root):
+            dirs.sort()
+            result.append((root, dirs, sorted(files)))
+        return result
+
+    def test_list_directory(self):
+        self.assertEquals(
+            list_directory(os.path.join(self.root, 'A Artist')),
+            (['First', 'Second'], [])
+        )
+        self.assertRaises(OSError, list_directory, os.path.join(self.root, 'missing'))
+
+    def test_walk(self):
+        self.assertEquals(list(TreeWalker(self.root).walk()), self.os_walk())
+
+    def test_albums(self):
+        albums = list(TreeWalker(self.root).albums())
+        self.assertEquals(albums, [
+            (os.path.join(self.root, 'A Artist/First'), ['01 Track.mp3']),
+            (os.path.join(self.root, 'A Artist/First/CD1'), ['01 Track.mp3']),
+            (os.path.join(self.root, 'A Artist/Second'), ['01 Track.flac']),
+            (os.path.join(self.root, 'B Artist/Album'), ['01 Track.mp3', '02 Track.mp3']),
+            (os.path.join(self.root, 'C Artist/Album'), ['01 Track.m4a']),
+        ])
+
+    def test_tracks(self):
+        tracks = list(MusaTree(self.root))
+        self.assertEquals(len(tracks), 6)
+        self.assertEquals(tracks[0].path, os.path.join(self.root, 'A Artist/First/01 Track.mp3'))
+        self.assertTrue(TreeWalker(self.root).has_tracks())
+        self.assertFalse(TreeWalker(os.path.join(self.root, 'Empty')).has_tracks())
+
+    def test_parallel_walk(self):
+        # Parallel listing returns entries in serial walk order
+        serial = list(TreeWalker(self.root, threads=1).walk())
+        for threads in (2, 8):
+            self.assertEquals(list(TreeWalker(self.root, threads=threads).walk()), serial)
+            self.assertEquals(
+                [t.path for t in MusaTree(self.root, threads=threads)],
+                [t.path for t in MusaTree(self.root)]
+            )
+
+    def test_parallel_window(self):
+        for i in range(30):
+            os.makedirs(os.path.join(self.root, 'Wide', '%02d' % i))
+        serial = list(TreeWalker(self.root).walk())
+        for window in (1, 3):
+            walker = counting_walker(self.root, threads=4, window=window)
+            entries = []
+            for entry in walker.walk():
+                entries.append(entry)
+                # Directories listed ahead of the walk stay within window
+                self.assertTrue(walker.listed - len(entries) <= window)
+            self.assertEquals(entries, serial)
+
+    def test_parallel_unreadable(self):
+        missing = TreeWalker(os.path.join(self.root, 'missing'), threads=4)
+        self.assertEquals(list(missing.walk()), [])
+
+    def test_parallel_listing_error(self):
+        # Errors from worker threads are raised in the walking thread
+        os.makedirs(os.path.join(self.root, 'B Artist', 'Fail'))
+        for threads in (1, 4):
+            walker = failing_walker(self.root, threads=threads)
+            self.assertRaises(ValueError, list, walker.walk())
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(tree_walker)
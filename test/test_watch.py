@@ -0,0 +1,108 @@
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from musa.watch import LibraryWatcher, PollingWatcher, is_watched_file
+
+
+class scripted_watcher(object):
+    """
+    Returns given sets of changes from successive wait() calls
+    """
+    def __init__(self, changes, step=0.01):
+        self.changes = list(changes)
+        self.step = step
+        self.closed = False
+
+    def wait(self, timeout):
+        time.sleep(self.step)
+        if not self.changes:
+            raise KeyboardInterrupt
+        return self.changes.pop(0)
+
+    def close(self):
+        self.closed = True
+
+
+class watch_fixture(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='musa-test-')
+        os.makedirs(os.path.join(self.root, 'Artist/Album'))
+        self.track = os.path.join(self.root, 'Artist/Album/01 Track.mp3')
+        open(self.track, 'w').write('\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+
+class library_watcher(watch_fixture):
+
+    def batches(self, changes, debounce, max_delay):
+        watcher = LibraryWatcher([self.root], debounce=debounce, max_delay=max_delay, polling=True)
+        watcher.watcher = scripted_watcher(changes)
+        batches = []
+        try:
+            for batch in watcher.batches():
+                batches.append(sorted(batch))
+        except KeyboardInterrupt:
+            pass
+        self.assertTrue(watcher.watcher.closed)
+        return batches
+
+    def test_debounce(self):
+        changes = [set(['a']), set(['b'])] + [set()] * 6 + [set(['c'])] + [set()] * 6
+        self.assertEquals(self.batches(changes, debounce=0.03, max_delay=10), [['a', 'b'], ['c']])
+
+    def test_max_delay(self):
+        # Changes arriving continuously are processed after max_delay
+        changes = [set(['%d' % i]) for i in range(20)]
+        batches = self.batches(changes, debounce=10, max_delay=0.05)
+        self.assertTrue(len(batches) >= 2)
+        changed = sorted(sum(batches, []), key=int)
+        self.assertEquals(changed, ['%d' % i for i in range(len(changed))])
+
+    def test_polling_mode(self):
+        watcher = LibraryWatcher([self.root], polling=True)
+        self.assertEquals(watcher.mode, 'polling')
+
+
+class polling_watcher(watch_fixture):
+
+    def test_is_watched_file(self):
+        self.assertTrue(is_watched_file('01 Track.mp3'))
+        self.assertFalse(is_watched_file('.musa-12345.mp3'))
+        self.assertFalse(is_watched_file('cover.jpg'))
+
+    def test_interval(self):
+        watcher = PollingWatcher([self.root], interval=60)
+        open(self.track, 'a').write('modified')
+        started = time.time()
+        self.assertEquals(watcher.wait(0.01), set())
+        self.assertTrue(time.time() - started < 1)
+
+    def test_changes(self):
+        watcher = PollingWatcher([self.root], interval=0)
+        self.assertEquals(watcher.wait(1), set())
+
+        open(self.track, 'a').write('modified')
+        os.makedirs(os.path.join(self.root, 'Artist/New'))
+        open(os.path.join(self.root, 'Artist/New/01 Track.mp3'), 'w').write('\n')
+        open(os.path.join(self.root, 'Artist/Album/cover.jpg'), 'w').write('\n')
+        self.assertEquals(watcher.wait(1), set([
+            os.path.join(self.root, 'Artist/Album'),
+            os.path.join(self.root, 'Artist/New'),
+        ]))
+
+        shutil.rmtree(os.path.join(self.root, 'Artist/New'))
+        self.assertEquals(watcher.wait(1), set([os.path.join(self.root, 'Artist/New')]))
+        self.assertEquals(watcher.wait(1), set())
+
+
+suite = unittest.TestSuite([
+    unittest.TestLoader().loadTestsFromTestCase(library_watcher),
+    unittest.TestLoader().loadTestsFromTestCase(polling_watcher),
+])